@@ -1,48 +1,366 @@
-from flask import Flask, request, abort, jsonify
+import os
+from flask import (Flask, Response, request, abort, make_response,
+                   stream_with_context)
 from flask_cors import CORS
-from models import setup_db, Movie, Actor
-from auth import requires_auth, AuthError
-
-
-def create_app(test_config=None):
+from werkzeug.exceptions import HTTPException
+from models import (setup_db, db, Movie, Actor, bulk_insert, bulk_update,
+                    bulk_delete, bulk_set_movie_actors, existing_ids,
+                    search_query, iter_export, row_count, pool_stats,
+                    listing, parse_release_date)
+from export import FORMATS, ndjson_lines, csv_lines
+from http_cache import conditional
+from serializer import init_serializer, jsonify
+from profiling import init_profiling
+from metrics import init_metrics, metrics
+from compression import init_compression
+from response_cache import response_cache, cached
+from bulk import (BulkError, MOVIE_FIELDS, ACTOR_FIELDS, parse_items,
+                  validate_create, validate_update, validate_delete,
+                  check_existing, check_actor_references, chunked)
+from auth import requires_auth, AuthError, jwks_store
+from pagination import (InvalidCursor, order_columns, order_clauses,
+                        decode_cursor, keyset_filter, cursor_for)
+
+
+def create_app(test_config=None, json_serializer=None):
     # create and configure the app
     app = Flask(__name__)
+    app.config.from_mapping(
+        DATABASE_URL=os.environ.get('DATABASE_URL'),
+        DB_CREATE_ALL=os.environ.get('DB_CREATE_ALL', '1') == '1',
+        DATABASE_REPLICA_URLS=[
+            url for url in
+            os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url],
+        REPLICA_STICKY_SECONDS=int(
+            os.environ.get('REPLICA_STICKY_SECONDS', 5)),
+        REPLICA_RETRY_SECONDS=int(
+            os.environ.get('REPLICA_RETRY_SECONDS', 30)),
+        JWKS_URL=jwks_store.source,
+        JWKS_PREWARM=os.environ.get('JWKS_PREWARM', '1') == '1',
+        PER_PAGE=int(os.environ.get('PER_PAGE', 10)),
+        MAX_PER_PAGE=int(os.environ.get('MAX_PER_PAGE', 100)),
+        BULK_MAX_ITEMS=int(os.environ.get('BULK_MAX_ITEMS', 10000)),
+        BULK_CHUNK_SIZE=int(os.environ.get('BULK_CHUNK_SIZE', 0)),
+        EXPORT_BATCH_SIZE=int(os.environ.get('EXPORT_BATCH_SIZE', 1000)),
+        JSON_BACKEND=os.environ.get('JSON_BACKEND', 'auto'),
+        PROFILING=os.environ.get('PROFILING', '0') == '1',
+        SERVER_TIMING={'1': True, '0': False}.get(
+            os.environ.get('SERVER_TIMING')),
+        PROFILE_SAMPLE_RATE=float(os.environ.get('PROFILE_SAMPLE_RATE', 1)),
+        SLOW_REQUEST_MS=float(os.environ.get('SLOW_REQUEST_MS', 500)),
+        SLOW_QUERY_MS=float(os.environ.get('SLOW_QUERY_MS', 100)),
+        RESPONSE_CACHE=os.environ.get('RESPONSE_CACHE', 'local'),
+        RESPONSE_CACHE_URL=os.environ.get('RESPONSE_CACHE_URL'),
+        RESPONSE_CACHE_SIZE=int(os.environ.get('RESPONSE_CACHE_SIZE', 1024)),
+        RESPONSE_CACHE_TTL=int(os.environ.get('RESPONSE_CACHE_TTL', 60)),
+        METRICS=os.environ.get('METRICS', '1') == '1',
+        METRICS_DIR=os.environ.get('METRICS_DIR'),
+        METRICS_FLUSH_SECONDS=float(
+            os.environ.get('METRICS_FLUSH_SECONDS', 1)),
+        COMPRESS=os.environ.get('COMPRESS', '1') == '1',
+        COMPRESS_MIN_SIZE=int(os.environ.get('COMPRESS_MIN_SIZE', 1024)),
+        COMPRESS_LEVEL=int(os.environ.get('COMPRESS_LEVEL', 6)),
+        COMPRESS_BROTLI_LEVEL=int(
+            os.environ.get('COMPRESS_BROTLI_LEVEL', 4)),
+    )
+    if test_config:
+        app.config.from_mapping(test_config)
     CORS(app)
+    init_serializer(app, json_serializer)
+    init_profiling(app)
     setup_db(app)
-
-    MOVIE_PER_PAGE = 10
+    response_cache.init_app(app)
+    if app.config['METRICS']:
+        init_metrics(app)
+    # after_request hooks run in reverse order: registered after them,
+    # compression runs before the metrics and profiling hooks, so they
+    # include its time
+    init_compression(app)
+
+    # fetch the signing keys up front so the first request
+    # does not pay for the JWKS round trip
+    if jwks_store.source != app.config['JWKS_URL']:
+        jwks_store.source = app.config['JWKS_URL']
+        jwks_store.clear()
+    if app.config['JWKS_PREWARM']:
+        jwks_store.prewarm()
 
     @app.after_request
     def after_request(response):
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
-        response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+        response.headers.add('Access-Control-Allow-Headers',
+                             'Content-Type,Authorization,true')
+        response.headers.add('Access-Control-Allow-Methods',
+                             'GET,PUT,POST,DELETE,OPTIONS')
+        return response
+
+    def get_per_page(request):
+        per_page = request.args.get('per_page', app.config['PER_PAGE'],
+                                    type=int)
+        return max(1, min(per_page, app.config['MAX_PER_PAGE']))
+
+    '''
+    paginate(request, query, order_by)
+      runs `query` sorted by `order_by` (which must end with the primary
+      key) for the requested page and counts the matching rows with a
+      separate COUNT query, unless the caller passes the `total` (the
+      maintained row count of an unfiltered listing). Only the rows of
+      the page are formatted.
+      Pages are selected with `page` (LIMIT/OFFSET) or, for deep paging,
+      with the opaque `cursor` returned as `next_cursor` by the previous
+      page (keyset pagination). Returns the formatted rows, the total
+      and the cursor of the next page (None on the last page).
+      A cursor that doesn't match the sort columns gets a 400 'invalid
+      cursor'. Orderings on computed expressions (e.g. search
+      relevance) can't be resumed from a cursor and pass
+      `cursors=False`. Rows are formatted with `projection` when
+      given, else with format().
+    '''
+    def paginate(request, query, order_by, cursors=True, total=None,
+                 projection=None):
+        order = order_columns(order_by)
+        per_page = get_per_page(request)
+        if total is None:
+            total = query.order_by(None).count()
+        query = query.order_by(*order_clauses(order))
+
+        cursor = request.args.get('cursor', None) if cursors else None
+        if cursor:
+            try:
+                values = decode_cursor(cursor, order)
+            except InvalidCursor:
+                abort(make_response(jsonify({
+                    'success': False,
+                    'error': 400,
+                    'message': 'invalid cursor'
+                }), 400))
+            query = query.filter(keyset_filter(order, values))
+        elif cursor is None:
+            page = request.args.get('page', 1, type=int)
+            if page < 1:
+                return [], total, None
+            query = query.offset((page-1)*per_page)
+
+        selection = query.limit(per_page + 1).all()
+        next_cursor = None
+        if len(selection) > per_page:
+            selection = selection[:per_page]
+            if cursors:
+                next_cursor = cursor_for(selection[-1], order)
+        if projection is not None:
+            current_items = [projection.format(item) for item in selection]
+        else:
+            current_items = [item.format() for item in selection]
+
+        return current_items, total, next_cursor
+
+    '''
+    projection_of(request, model)
+      reads the sparse fieldset of a read endpoint: `fields`, a comma
+      separated list of the columns to return (all by default, the id
+      is always returned), and `include`, the relationship to embed
+      (`actors` for movies, `movies` for actors, the default) or
+      `none`. Responds with 400 on unknown names.
+    '''
+    def projection_of(request, model):
+        fields = request.args.get('fields', None)
+        if fields is not None:
+            fields = [name.strip() for name in fields.split(',')
+                      if name.strip()]
+            if not fields or \
+                    any(name not in model.FIELDS for name in fields):
+                abort(400)
+        include = request.args.get('include', model.RELATIONSHIP)
+        if include == 'none':
+            include = None
+        elif include != model.RELATIONSHIP:
+            abort(400)
+        return model.projection(fields, include)
+
+    '''
+    release_date_of(value)
+      parses the `release_date` of a movie payload (see
+      models.parse_release_date), responding with 400 when it isn't a
+      date.
+    '''
+    def release_date_of(value):
+        try:
+            return parse_release_date(value)
+        except ValueError:
+            abort(400)
+
+    '''
+    resolve_actor_ids(actor_ids)
+      validates the `actors` list of a movie payload with a single IN
+      query and returns the ids without duplicates. Responds with 400,
+      listing every unknown id, when some actors don't exist.
+    '''
+    def resolve_actor_ids(actor_ids):
+        if not isinstance(actor_ids, list) or \
+                not all(type(actor_id) is int for actor_id in actor_ids):
+            abort(400)
+        actor_ids = list(dict.fromkeys(actor_ids))
+
+        missing = Actor.missing_ids(actor_ids)
+        if missing:
+            abort(make_response(jsonify({
+                'success': False,
+                'error': 400,
+                'message': 'bad request',
+                'missing_actors': missing
+            }), 400))
+        return actor_ids
+
+    '''
+    wants_representation(request)
+      tells whether the client asked for the legacy full-list body of
+      the mutation endpoints, with `Prefer: return=representation` or
+      the `return=representation` query argument.
+    '''
+    def wants_representation(request):
+        if request.args.get('return', None) == 'representation':
+            return True
+        prefer = request.headers.get('Prefer', '')
+        preferences = [part.strip().lower()
+                       for part in prefer.replace(';', ',').split(',')]
+        return 'return=representation' in preferences
+
+    '''
+    mutation_response(body, resource, query, order_by)
+      completes the response of a mutation endpoint. By default only a
+      count is added to `body`; the legacy page of `resource`s is only
+      loaded when the client asks for it.
+    '''
+    def mutation_response(body, resource, query, order_by):
+        if wants_representation(request):
+            items, total, _ = paginate(request, query, order_by,
+                                       total=row_count(resource))
+            body[resource + 's'] = items
+            applied = 'return=representation'
+        else:
+            total = row_count(resource)
+            applied = 'return=minimal'
+        body['total_' + resource + 's'] = total
+        response = jsonify(body)
+        response.headers['Preference-Applied'] = applied
+        return response
+
+    '''
+    bulk_items(request)
+      parses the JSON array or NDJSON body of a bulk request.
+    '''
+    def bulk_items(request):
+        try:
+            return parse_items(request, app.config['BULK_MAX_ITEMS'])
+        except BulkError as e:
+            abort(e.status_code)
+
+    '''
+    run_bulk(results, rows, write, status, resource, model)
+      writes the validated `rows` of a bulk request with `write(chunk)`,
+      which returns the ids of the chunk. Nothing is written when an
+      item is invalid, and the valid items are reported `skipped`. All
+      rows go in one transaction unless a chunk size is set
+      (`chunk_size` argument or BULK_CHUNK_SIZE), in which case every
+      chunk is committed on its own and a failing chunk stops the
+      batch.
+    '''
+    def run_bulk(results, rows, write, status, resource, model):
+        status_code = 200
+        if any(result['status'] is not None for result in results):
+            status_code = 400
+            for row in rows:
+                results[row['index']].update(status='skipped')
+            rows = []
+
+        chunk_size = request.args.get('chunk_size',
+                                      app.config['BULK_CHUNK_SIZE'],
+                                      type=int)
+        chunks = list(chunked(rows, chunk_size if chunk_size > 0
+                              else max(len(rows), 1)))
+        for number, chunk in enumerate(chunks):
+            try:
+                ids = write(chunk)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                for failed in chunks[number:]:
+                    for row in failed:
+                        results[row['index']].update(
+                            status='failed', error='write failed')
+                status_code = 422
+                break
+            for row, row_id in zip(chunk, ids):
+                results[row['index']].update(status=status, id=row_id)
+
+        response = jsonify({
+            'success': status_code == 200,
+            'results': results,
+            'total_' + resource + 's': row_count(resource)
+        })
+        response.status_code = status_code
         return response
 
+    '''
+    export_response(model, name, links_key)
+      streams every row of `model` as NDJSON (default) or CSV, chosen
+      with the `format` argument. With `links=1` each row also lists
+      the ids of its related rows under `links_key`.
+    '''
+    def export_response(model, name, links_key):
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in FORMATS:
+            abort(400)
+        links = request.args.get('links', '0') in ('1', 'true')
+
+        rows = iter_export(model, links, app.config['EXPORT_BATCH_SIZE'])
+        if export_format == 'csv':
+            fields = [column.name for column in model.__table__.columns]
+            if links:
+                fields.append(links_key)
+            body = csv_lines(rows, fields)
+        else:
+            body = ndjson_lines(rows, app.extensions['serializer'].dumps)
 
-    def paginate_movies(request, selection):
-        page = request.args.get('page', 1, type=int)
-        start = (page-1)*MOVIE_PER_PAGE
-        end = start+MOVIE_PER_PAGE
+        response = Response(stream_with_context(body),
+                            mimetype=FORMATS[export_format])
+        response.headers['Content-Disposition'] = \
+            f'attachment; filename={name}.{export_format}'
+        return response
 
-        items = [item.format() for item in selection]
-        current_items = items[start:end]
+    MOVIE_PARSERS = {'release_date': parse_release_date}
 
-        return current_items
+    SEARCHABLE = {
+        'movies': ('view:movies', Movie, Movie.title),
+        'actors': ('view:actors', Actor, Actor.name),
+    }
 
     # Endpoints
 
     '''
     An endpoint to handle GET requests for listing movies,
-    including pagination (every 10 movies).
+    including pagination (10 movies per page by default, adjustable
+    with the `per_page` argument up to MAX_PER_PAGE).
     This endpoint returns a list of movies and
     number of total movies.
     '''
     @app.route('/movies', methods=['GET'])
     @requires_auth('view:movies')
+    @cached('movies')
+    @conditional()
     def retrieve_movies(payload):
+        projection = projection_of(request, Movie)
+        try:
+            query, order_by, filtered = listing(Movie, request.args,
+                                                projection)
+        except ValueError:
+            abort(400)
         try:
-            movies = Movie.query.order_by(Movie.id).all()
-            current_movies = paginate_movies(request, movies)
+            current_movies, total_movies, next_cursor = paginate(
+                request, query, order_by,
+                total=None if filtered else row_count('movie'),
+                projection=projection)
+        except HTTPException:
+            raise
         except Exception:
             return abort(500)
 
@@ -52,12 +370,14 @@ def create_app(test_config=None):
         return jsonify({
                 'success': True,
                 'movies': current_movies,
-                'total_movies': len(movies)
+                'total_movies': total_movies,
+                'next_cursor': next_cursor
                 })
     '''
     An endpoint to handle POST requests for creating a new movie
     which requieres movie title, release date and actors.This endpoint
-    returns created movie's id, movie list and total movies number.
+    returns created movie's id, the movie and total movies number
+    (plus a page of movies with `Prefer: return=representation`).
     '''
     @app.route('/movies', methods=['POST'])
     @requires_auth('add:movie')
@@ -69,37 +389,34 @@ def create_app(test_config=None):
         search = body.get('search', None)
 
         if search:
-            movies = Movie.query.filter(Movie.title.ilike(f'%{search}%')).all()
-            current_movies = paginate_movies(request, movies)
+            selection, order_by = search_query(Movie, Movie.title, search)
+            current_movies, total_movies, next_cursor = paginate(
+                request, selection, order_by, cursors=False)
 
             return jsonify({
                 'success': True,
                 'movies': current_movies,
-                'total_movies': len(movies)
+                'total_movies': total_movies,
+                'next_cursor': next_cursor
                 })
         else:
             if (movie_title is None) or (movie_release_date is None):
                 abort(400)
+        movie_release_date = release_date_of(movie_release_date)
+        if movie_actors:
+            movie_actors = resolve_actor_ids(movie_actors)
         movie = Movie(release_date=movie_release_date,
                       title=movie_title)
         try:
             if movie_actors:
-                for actor_id in movie_actors:
-                    actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-                    if not actor:
-                        abort(400)
-                    movie.actors.append(actor)
+                movie.set_actors(movie_actors)
             movie.insert()
 
-            movies = Movie.query.order_by(Movie.id).all()
-            current_movies = paginate_movies(request, movies)
-
-            return jsonify({
+            return mutation_response({
                 'success': True,
                 'created': movie.id,
-                'movies': current_movies,
-                'total_movies': len(movies)
-                })
+                'movie': movie.format()
+                }, 'movie', Movie.list_query(), [Movie.id])
         except Exception:
             abort(500)
 
@@ -109,16 +426,20 @@ def create_app(test_config=None):
     '''
     @app.route('/movies/<int:movie_id>', methods=['GET'])
     @requires_auth('view:movies')
+    @cached('movies')
+    @conditional()
     def retrieve_single_movie(payload, movie_id):
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        projection = projection_of(request, Movie)
+        movie = Movie.detail_query(projection) \
+            .filter(Movie.id == movie_id).one_or_none()
 
         if not movie:
             abort(404)
 
         return jsonify({
             'success': True,
-            'movie': movie.format(),
-            'total_movies': Movie.query.count()
+            'movie': projection.format(movie),
+            'total_movies': row_count('movie')
         })
 
     '''
@@ -142,27 +463,20 @@ def create_app(test_config=None):
         if movie_title:
             movie.title = movie_title
         if movie_release_date:
-            movie.release_date = movie_release_date
+            movie.release_date = release_date_of(movie_release_date)
         if movie_actors:
-            actors = []
-            for actor_id in movie_actors:
-                actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-                if not actor:
-                    abort(400)
-                actors.append(actor)
-            movie.actors = actors
+            movie_actors = resolve_actor_ids(movie_actors)
         try:
+            if movie_actors:
+                movie.set_actors(movie_actors)
             movie.update()
-            movies = Movie.query.order_by(Movie.id).all()
-            current_movies = paginate_movies(request, movies)
 
-            return jsonify({
+            return mutation_response({
                 'success': True,
                 'message': 'Updated succesfully',
                 'updated': movie.id,
-                'movies': current_movies,
-                'total_movies': Movie.query.count()
-            })
+                'movie': movie.format()
+            }, 'movie', Movie.list_query(), [Movie.id])
         except Exception:
             abort(422)
 
@@ -180,31 +494,177 @@ def create_app(test_config=None):
 
         try:
             movie.delete()
-            movies = Movie.query.order_by(Movie.id).all()
-            current_movies = paginate_movies(request, movies)
 
-            return jsonify({
+            return mutation_response({
                 'success': True,
                 'message': 'Deleted succesfully',
-                'deleted': movie_id,
-                'movies': current_movies,
-                'total_movies': len(movies)
-            })
+                'deleted': movie_id
+            }, 'movie', Movie.list_query(), [Movie.id])
         except Exception:
             abort(422)
 
+    '''
+    Endpoints to create, update and delete many movies at once.
+    They accept a JSON array or an NDJSON body (one item per line)
+    and return one result per item, in input order.
+    Items are validated up front, actor ids of all the items are
+    resolved with one query, and rows are written with multi-row
+    statements in one transaction (or in chunks, see run_bulk).
+    '''
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('add:movie')
+    def bulk_create_movies(payload):
+        items = bulk_items(request)
+        results, rows = validate_create(items, MOVIE_FIELDS, ('actors',),
+                                        MOVIE_PARSERS)
+        rows = check_actor_references(results, rows, Actor.missing_ids)
+
+        def write(chunk):
+            ids = bulk_insert(Movie, [row['values'] for row in chunk])
+            bulk_set_movie_actors({
+                movie_id: row['relations']['actors']
+                for row, movie_id in zip(chunk, ids)
+                if 'actors' in row['relations']
+            })
+            return ids
+
+        return run_bulk(results, rows, write, 'created', 'movie', Movie)
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('edit:movie')
+    def bulk_update_movies(payload):
+        items = bulk_items(request)
+        results, rows = validate_update(items, MOVIE_FIELDS, ('actors',),
+                                        MOVIE_PARSERS)
+        rows = check_existing(results, rows,
+                              lambda ids: existing_ids(Movie, ids))
+        rows = check_actor_references(results, rows, Actor.missing_ids)
+
+        def write(chunk):
+            bulk_update(Movie, [dict(row['values'], id=row['id'])
+                                for row in chunk])
+            bulk_set_movie_actors({
+                row['id']: row['relations']['actors']
+                for row in chunk if 'actors' in row['relations']
+            }, replace=True)
+            return [row['id'] for row in chunk]
+
+        return run_bulk(results, rows, write, 'updated', 'movie', Movie)
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    def bulk_delete_movies(payload):
+        items = bulk_items(request)
+        results, rows = validate_delete(items)
+        rows = check_existing(results, rows,
+                              lambda ids: existing_ids(Movie, ids))
+
+        def write(chunk):
+            ids = [row['id'] for row in chunk]
+            bulk_delete(Movie, ids)
+            return ids
+
+        return run_bulk(results, rows, write, 'deleted', 'movie', Movie)
+
+    '''
+    An endpoint to handle GET requests for searching movies by title
+    (`type=movies`, the default) or actors by name (`type=actors`)
+    with the `q` argument. Results are ranked by relevance and
+    paginated in the database. Requires the view permission of the
+    searched type.
+    '''
+    @app.route('/search', methods=['GET'])
+    def search():
+        kind = request.args.get('type', 'movies')
+        term = request.args.get('q', '').strip()
+        if kind not in SEARCHABLE or not term:
+            abort(400)
+        permission, model, column = SEARCHABLE[kind]
+
+        @requires_auth(permission)
+        @conditional()
+        def run_search(payload):
+            projection = projection_of(request, model)
+            selection, order_by = search_query(model, column, term,
+                                               projection)
+            results, total, _ = paginate(request, selection, order_by,
+                                         cursors=False, projection=projection)
+            return jsonify({
+                'success': True,
+                kind: results,
+                'total_' + kind: total
+            })
+
+        return run_search()
+
+    '''
+    Endpoints to handle GET requests for exporting the whole catalog
+    of movies or actors as a stream (see export_response). Memory
+    use doesn't depend on the size of the tables.
+    '''
+    @app.route('/export/movies', methods=['GET'])
+    @requires_auth('view:movies')
+    @conditional()
+    def export_movies(payload):
+        return export_response(Movie, 'movies', 'actor_ids')
+
+    @app.route('/export/actors', methods=['GET'])
+    @requires_auth('view:actors')
+    @conditional()
+    def export_actors(payload):
+        return export_response(Actor, 'actors', 'movie_ids')
+
+    '''
+    An endpoint reporting the database connection pool of the worker
+    serving the request: its size, connections in use and idle, and
+    how long checkouts waited. It doesn't touch the database, so it
+    answers even when the pool is exhausted.
+    '''
+    @app.route('/health/pool', methods=['GET'])
+    def pool_health():
+        return jsonify({
+            'success': True,
+            'pool': pool_stats()
+        })
+
+    '''
+    An endpoint exposing the request, authentication, pool and cache
+    metrics of every worker in the Prometheus text format, for
+    scraping. Like `/health/pool` it needs no token, so it should
+    only be reachable from the monitoring network.
+    '''
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        if not app.config['METRICS']:
+            abort(404)
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
     '''
     An endpoint to handle GET requests for listing actors,
-    including pagination (every 10 movies).
+    including pagination (10 actors per page by default, adjustable
+    with the `per_page` argument up to MAX_PER_PAGE).
     This endpoint returns a list of actors and
     number of total actors.
     '''
     @app.route('/actors', methods=['GET'])
     @requires_auth('view:actors')
+    @cached('actors')
+    @conditional()
     def retrieve_actors(payload):
+        projection = projection_of(request, Actor)
         try:
-            actors = Actor.query.order_by(Actor.id).all()
-            current_actors = paginate_movies(request, actors)
+            query, order_by, filtered = listing(Actor, request.args,
+                                                projection)
+        except ValueError:
+            abort(400)
+        try:
+            current_actors, total_actors, next_cursor = paginate(
+                request, query, order_by,
+                total=None if filtered else row_count('actor'),
+                projection=projection)
+        except HTTPException:
+            raise
         except Exception:
             return abort(500)
 
@@ -214,13 +674,15 @@ def create_app(test_config=None):
         return jsonify({
                 'success': True,
                 'actors': current_actors,
-                'total_actors': len(actors)
+                'total_actors': total_actors,
+                'next_cursor': next_cursor
                 })
 
     '''
     An endpoint to handle POST requests for creating a new actor
     which requieres actor name, age and gender.
-    This endpoint returns created actor's id, actors list and total number.
+    This endpoint returns created actor's id, the actor and total number
+    (plus a page of actors with `Prefer: return=representation`).
     '''
     @app.route('/actors', methods=['POST'])
     @requires_auth('add:actor')
@@ -234,13 +696,15 @@ def create_app(test_config=None):
         search = body.get('search', None)
 
         if search:
-            actors = Actor.query.filter(Actor.name.ilike(f'%{search}%')).all()
-            current_actors = paginate_movies(request, actors)
+            selection, order_by = search_query(Actor, Actor.name, search)
+            current_actors, total_actors, next_cursor = paginate(
+                request, selection, order_by, cursors=False)
 
             return jsonify({
                 'success': True,
                 'actors': current_actors,
-                'total_actors': len(actors)
+                'total_actors': total_actors,
+                'next_cursor': next_cursor
                 })
         else:
             if (actor_name is None) or (actor_age is None) \
@@ -252,15 +716,11 @@ def create_app(test_config=None):
                           gender=actor_gender)
             actor.insert()
 
-            actors = Actor.query.order_by(Actor.id).all()
-            current_actors = paginate_movies(request, actors)
-
-            return jsonify({
+            return mutation_response({
                 'success': True,
                 'created': actor.id,
-                'actors': current_actors,
-                'total_actors': len(actors)
-                })
+                'actor': actor.format()
+                }, 'actor', Actor.list_query(), [Actor.id])
         except Exception:
             abort(500)
 
@@ -270,16 +730,20 @@ def create_app(test_config=None):
     '''
     @app.route('/actors/<int:actor_id>', methods=['GET'])
     @requires_auth('view:actors')
+    @cached('actors')
+    @conditional()
     def retrieve_single_actor(payload, actor_id):
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+        projection = projection_of(request, Actor)
+        actor = Actor.detail_query(projection) \
+            .filter(Actor.id == actor_id).one_or_none()
 
         if not actor:
             abort(404)
 
         return jsonify({
             'success': True,
-            'actor': actor.format(),
-            'total_movies': Actor.query.count()
+            'actor': projection.format(actor),
+            'total_actors': row_count('actor')
         })
 
     '''
@@ -309,16 +773,13 @@ def create_app(test_config=None):
             actor.age = actor_age
         try:
             actor.update()
-            actors = Actor.query.order_by(Actor.id).all()
-            current_actors = paginate_movies(request, actors)
 
-            return jsonify({
+            return mutation_response({
                 'success': True,
                 'message': 'Updated succesfully',
                 'updated': actor.id,
-                'actors': current_actors,
-                'total_actors': Actor.query.count()
-            })
+                'actor': actor.format()
+            }, 'actor', Actor.list_query(), [Actor.id])
         except Exception:
             abort(422)
 
@@ -336,19 +797,60 @@ def create_app(test_config=None):
 
         try:
             actor.delete()
-            actors = Actor.query.order_by(Actor.id).all()
-            current_actors = paginate_movies(request, actors)
 
-            return jsonify({
+            return mutation_response({
                 'success': True,
                 'message': 'Deleted succesfully',
-                'deleted': actor_id,
-                'actors': current_actors,
-                'total_actors': len(actors)
-            })
+                'deleted': actor_id
+            }, 'actor', Actor.list_query(), [Actor.id])
         except Exception:
             abort(422)
 
+    '''
+    Endpoints to create, update and delete many actors at once,
+    with the same body and result format as the movie ones.
+    '''
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('add:actor')
+    def bulk_create_actors(payload):
+        items = bulk_items(request)
+        results, rows = validate_create(items, ACTOR_FIELDS)
+
+        def write(chunk):
+            return bulk_insert(Actor, [row['values'] for row in chunk])
+
+        return run_bulk(results, rows, write, 'created', 'actor', Actor)
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('edit:actor')
+    def bulk_update_actors(payload):
+        items = bulk_items(request)
+        results, rows = validate_update(items, ACTOR_FIELDS)
+        rows = check_existing(results, rows,
+                              lambda ids: existing_ids(Actor, ids))
+
+        def write(chunk):
+            bulk_update(Actor, [dict(row['values'], id=row['id'])
+                                for row in chunk])
+            return [row['id'] for row in chunk]
+
+        return run_bulk(results, rows, write, 'updated', 'actor', Actor)
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actor')
+    def bulk_delete_actors(payload):
+        items = bulk_items(request)
+        results, rows = validate_delete(items)
+        rows = check_existing(results, rows,
+                              lambda ids: existing_ids(Actor, ids))
+
+        def write(chunk):
+            ids = [row['id'] for row in chunk]
+            bulk_delete(Actor, ids)
+            return ids
+
+        return run_bulk(results, rows, write, 'deleted', 'actor', Actor)
+
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({
@@ -357,6 +859,14 @@ def create_app(test_config=None):
             'message': 'page not found'
         }), 404
 
+    @app.errorhandler(413)
+    def request_too_large(error):
+        return jsonify({
+            'success': False,
+            'error': 413,
+            'message': 'request entity too large'
+        }), 413
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -399,6 +909,8 @@ def create_app(test_config=None):
 
     @app.errorhandler(AuthError)
     def auth_error(ex):
+        metrics.inc('auth_failures_total',
+                    code=ex.error.get('code', 'unknown'))
         res = jsonify(ex.error)
         res.status_code = ex.status_code
         return res
@@ -406,8 +918,18 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
+def __getattr__(name):
+    '''
+    The module level `app` (used by manage.py) is created on first
+    access, so importing this module has no side effects. gunicorn
+    builds the app with the `app:create_app()` factory.
+    '''
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
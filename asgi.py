@@ -0,0 +1,87 @@
+import asyncio
+import contextlib
+import logging
+import os
+
+import httpx
+from a2wsgi import WSGIMiddleware
+
+from app import create_app
+from auth import jwks_store
+from models import dispose_engine
+
+
+'''
+ASGI entry point, an alternative to the sync gunicorn workers:
+
+  uvicorn --factory asgi:create_asgi_app --workers 2
+
+It serves the same Flask app as the WSGI mode, so routes, payloads,
+`requires_auth` checks and error shapes are identical. It does not
+make the handlers asynchronous: the pinned SQLAlchemy 1.3 has no
+asyncio support, so every request runs, database queries included, on
+one of ASGI_THREADS threads (default 10, sized like the database pool)
+and a worker serves at most that many requests at once, like a
+threaded gunicorn worker.
+
+What the event loop adds is the key refresh: the signing keys are
+fetched with an async HTTP client (httpx) when the server starts and
+refreshed on the loop every JWKS_TTL / 2 seconds, so they are never
+stale and no request waits on a JWKS fetch (only a token with an
+unknown `kid` still triggers a rate limited fetch).
+'''
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 10))
+
+logger = logging.getLogger(__name__)
+
+
+class ASGIApplication:
+    def __init__(self, flask_app, prewarm=True, threads=ASGI_THREADS):
+        self.flask_app = flask_app
+        self.wsgi = WSGIMiddleware(flask_app, workers=threads)
+        self.prewarm = prewarm
+        self.client = None
+        self.refresher = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        self.client = httpx.AsyncClient()
+        if self.prewarm:
+            await jwks_store.refresh_async(self.client)
+        self.refresher = asyncio.ensure_future(self.refresh_keys())
+
+    async def shutdown(self):
+        self.refresher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.refresher
+        await self.client.aclose()
+        dispose_engine()
+
+    async def refresh_keys(self):
+        while True:
+            await asyncio.sleep(max(jwks_store.ttl / 2, 1))
+            await jwks_store.refresh_async(self.client)
+
+
+def create_asgi_app(test_config=None):
+    # the keys are fetched asynchronously on startup instead
+    prewarm = os.environ.get('JWKS_PREWARM', '1') == '1'
+    flask_app = create_app(dict(test_config or {}, JWKS_PREWARM=False))
+    return ASGIApplication(flask_app, prewarm=prewarm)
@@ -1,14 +1,33 @@
 from flask import abort, request
 from functools import wraps
+import asyncio
+import hashlib
 import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
 from jose import jwt
 from urllib.request import urlopen
 
+from profiling import timed
+
 
 AUTH0_DOMAIN = 'wjj.eu.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'capstone'
 
+JWKS_URL = os.environ.get('JWKS_URL',
+                          f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+logger = logging.getLogger(__name__)
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -46,26 +65,274 @@ def get_headers_auth_token():
     token = parts[1]
     return token
 
+
+class JWKSStore:
+    '''
+    In-process store of the signing keys published in a JWKS document,
+    indexed by `kid`.
+
+    Keys are served from memory for `ttl` seconds. Once they are stale
+    they keep being served while a background refresh runs, so a JWKS
+    outage only matters for keys we have never seen. An unknown `kid`
+    forces a synchronous refresh. Either way at most one fetch is
+    attempted every `min_refresh_interval` seconds, failed ones
+    included, so forged tokens or a JWKS outage cannot trigger a fetch
+    storm. `source` may be an http(s)/file URL or a local path.
+    '''
+    def __init__(self, source, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.source = source
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _load(self):
+        if '://' in self.source:
+            with urlopen(self.source, timeout=self.timeout) as response:
+                jwks = json.loads(response.read())
+        else:
+            with open(self.source) as f:
+                jwks = json.load(f)
+        return self._parse(jwks)
+
+    def _parse(self, jwks):
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys
+
+    def refresh(self):
+        '''
+        Fetches the JWKS document and replaces the cached keys.
+        On failure the previous keys are kept and False is returned.
+        '''
+        with self._lock:
+            self._last_attempt = time.monotonic()
+        try:
+            keys = self._load()
+        except Exception:
+            logger.exception('Unable to fetch JWKS from %s', self.source)
+            return False
+        self._install(keys)
+        return True
+
+    async def refresh_async(self, client):
+        '''
+        Same as refresh(), for event loops: http(s) sources are fetched
+        with `client`, an async HTTP client such as httpx.AsyncClient,
+        and other sources are read in the default executor.
+        '''
+        if not self.source.startswith(('http://', 'https://')):
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.refresh)
+        with self._lock:
+            self._last_attempt = time.monotonic()
+        try:
+            response = await client.get(self.source, timeout=self.timeout)
+            response.raise_for_status()
+            keys = self._parse(response.json())
+        except Exception:
+            logger.exception('Unable to fetch JWKS from %s', self.source)
+            return False
+        self._install(keys)
+        return True
+
+    def _install(self, keys):
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+
+    def prewarm(self):
+        return self.refresh()
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+    def peek(self, kid):
+        '''
+        Returns the cached key for `kid` without ever fetching
+        synchronously, so callers can check a key is still published.
+        '''
+        if self._keys and self._is_stale():
+            self._revalidate_in_background()
+        return self._keys.get(kid)
+
+    def _is_stale(self):
+        return (self._fetched_at is None or
+                time.monotonic() - self._fetched_at > self.ttl)
+
+    def _may_force_refresh(self):
+        return (self._last_attempt is None or
+                time.monotonic() - self._last_attempt >=
+                self.min_refresh_interval)
+
+    def _claim_attempt(self):
+        '''
+        Records a fetch attempt and returns True, unless one was made
+        less than `min_refresh_interval` seconds ago.
+        '''
+        with self._lock:
+            if not self._may_force_refresh():
+                return False
+            self._last_attempt = time.monotonic()
+            return True
+
+    def _revalidate_in_background(self):
+        with self._lock:
+            if self._refreshing or not self._may_force_refresh():
+                return
+            self._refreshing = True
+            self._last_attempt = time.monotonic()
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self, kid):
+        '''
+        Returns the key for `kid`, or None when it is not published.
+        '''
+        if not self._keys:
+            if self._claim_attempt():
+                self.refresh()
+        elif self._is_stale():
+            self._revalidate_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._fetched_at is not None \
+                and self._claim_attempt():
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+
+jwks_store = JWKSStore(JWKS_URL)
+
+
+VerifiedToken = namedtuple('VerifiedToken',
+                           ['payload', 'permissions', 'expires_at', 'key'])
+
+
+class TokenCache:
+    '''
+    Bounded LRU of verified tokens, keyed by a hash of the raw token.
+
+    An entry is only returned while its `exp` is in the future and the
+    key that signed it is still published by `jwks_store`, so expired
+    tokens and tokens signed by a rotated-out key are verified again.
+    '''
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, store=None):
+        self.maxsize = maxsize
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        digest = self._hash(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                if entry.expires_at <= time.time() or \
+                        self.store.peek(entry.key['kid']) != entry.key:
+                    del self._entries[digest]
+                    entry = None
+                else:
+                    self._entries.move_to_end(digest)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, token, payload, key):
+        '''
+        Wraps a verified payload in a VerifiedToken and stores it,
+        unless the cache is disabled or the token has no `exp`.
+        '''
+        permissions = None
+        if 'permissions' in payload:
+            permissions = frozenset(payload['permissions'])
+        entry = VerifiedToken(payload, permissions, payload.get('exp'), key)
+        if self.maxsize <= 0 or not isinstance(entry.expires_at, (int, float)):
+            return entry
+        digest = self._hash(token)
+        with self._lock:
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
+
+
+token_cache = TokenCache(store=jwks_store)
+
+
+def verify_token(token):
+    '''
+    Verifies `token` and returns its VerifiedToken, reusing the
+    result of an earlier verification when it is still valid.
+    '''
+    entry = token_cache.get(token)
+    if entry is not None:
+        return entry
+
+    payload, key = _decode_jwt(token)
+    return token_cache.put(token, payload, key)
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    return verify_token(token).payload
+
+
+def _decode_jwt(token):
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get(unverified_header['kid'])
 
     if rsa_key:
         try:
@@ -77,7 +344,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
-            return payload
+            return payload, rsa_key
 
         except jwt.ExpiredSignatureError:
             raise AuthError({
@@ -101,14 +368,16 @@ def verify_decode_jwt(token):
             }, 400)
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, permissions=None):
     if 'permissions' not in payload:
                         raise AuthError({
                             'code': 'invalid_claims',
                             'description': 'Permissions not included in JWT.'
                         }, 400)
 
-    if permission not in payload['permissions']:
+    if permissions is None:
+        permissions = payload['permissions']
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -121,8 +390,10 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_headers_auth_token()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            with timed('auth'):
+                verified = verify_token(token)
+            check_permissions(permission, verified.payload,
+                              verified.permissions)
+            return f(verified.payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,339 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import rsa
+from jose import jwk, jwt
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import create_app
+from auth import AUTH0_DOMAIN, API_AUDIENCE
+from models import db, Movie, Actor, bulk_insert, bulk_set_movie_actors
+
+
+'''
+Load test and benchmark harness.
+
+Boots the app in process against a local database (a temporary SQLite
+file by default, or --database-url, e.g. a local PostgreSQL), with a
+local JWKS file and RS256 tokens signed by a key generated for the
+run, so it needs neither Auth0 nor existing data. It seeds --movies
+movies and --actors actors (with --cast actors per movie), then sends
+--requests requests to every endpoint from --concurrency threads and
+reports requests/sec, p50/p95/p99 latency and SQL queries per request:
+
+  python bench.py --movies 5000 --actors 2000 --requests 500
+  python bench.py --save bench_baseline.json
+  python bench.py --compare bench_baseline.json
+
+--save stores the results with the commit they were measured on.
+--compare prints the change from such a baseline and exits with 1
+when a scenario regressed by more than --tolerance (p95 latency,
+requests/sec or queries per request), so it can gate a CI job. Compare
+runs made with the same parameters on the same machine. The response
+cache is off unless --response-cache local is given, so reads measure
+the database path. Requests go through Flask's test client: the
+numbers include the app and the database, not the HTTP server.
+'''
+
+PERMISSIONS = ['add:actor', 'add:movie', 'delete:actor', 'delete:movie',
+               'edit:actor', 'edit:movie', 'view:actors', 'view:movies']
+KID = 'bench'
+
+
+class LocalIssuer:
+    '''
+    Stand-in for Auth0: an RSA key whose public half is written as a
+    JWKS file, and tokens signed with it.
+    '''
+    def __init__(self, directory):
+        _, private_key = rsa.newkeys(2048)
+        self.private_key = private_key.save_pkcs1().decode('ascii')
+        public_key = jwk.construct(self.private_key, 'RS256') \
+            .public_key().to_dict()
+        public_key.update(kid=KID, use='sig')
+        self.jwks_path = os.path.join(directory, 'jwks.json')
+        with open(self.jwks_path, 'w') as f:
+            json.dump({'keys': [public_key]}, f)
+
+    def token(self, permissions=PERMISSIONS, expires_in=3600):
+        now = int(time.time())
+        return jwt.encode({
+            'iss': f'https://{AUTH0_DOMAIN}/',
+            'aud': API_AUDIENCE,
+            'sub': 'bench|1',
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': permissions
+        }, self.private_key, algorithm='RS256', headers={'kid': KID})
+
+
+def seed(app, movies, actors, cast, rng):
+    '''
+    Inserts the data set and returns the ids of the movies and actors.
+    '''
+    with app.app_context():
+        actor_ids = []
+        for start in range(0, actors, 1000):
+            actor_ids += bulk_insert(Actor, [
+                {'name': f'Actor {i}', 'age': 20 + i % 50,
+                 'gender': rng.choice(['Female', 'Male'])}
+                for i in range(start, min(start + 1000, actors))])
+        movie_ids = []
+        for start in range(0, movies, 1000):
+            movie_ids += bulk_insert(Movie, [
+                {'title': f'Movie {i}',
+                 'release_date': date(2000 + i % 20, 1 + i % 12, 1 + i % 28)}
+                for i in range(start, min(start + 1000, movies))])
+        if actor_ids and cast:
+            bulk_set_movie_actors({
+                movie_id: rng.sample(actor_ids, min(cast, len(actor_ids)))
+                for movie_id in movie_ids})
+        db.session.commit()
+    return movie_ids, actor_ids
+
+
+def scenarios(movie_ids, actor_ids, disposable, per_page):
+    '''
+    Returns {name: build(rng) -> (method, url, json)} for every endpoint.
+    Deletes consume the `disposable` ids, seeded for that purpose.
+    '''
+    pages = max(len(movie_ids) // per_page, 1)
+    actor_pages = max(len(actor_ids) // per_page, 1)
+    return {
+        'GET /movies': lambda rng: (
+            'get', f'/movies?page={rng.randint(1, pages)}', None),
+        'GET /movies (id,title)': lambda rng: (
+            'get', f'/movies?page={rng.randint(1, pages)}'
+                   '&fields=id,title&include=none', None),
+        'GET /movies (filtered)': lambda rng: (
+            'get', f'/movies?release_from={2000 + rng.randint(0, 15)}-01-01'
+                   f'&release_to={2015 + rng.randint(0, 4)}-12-31'
+                   '&sort=-release_date', None),
+        'GET /movies/<id>': lambda rng: (
+            'get', f'/movies/{rng.choice(movie_ids)}', None),
+        'GET /actors': lambda rng: (
+            'get', f'/actors?page={rng.randint(1, actor_pages)}', None),
+        'GET /actors (filtered)': lambda rng: (
+            'get', f'/actors?gender={rng.choice(["female", "male"])}'
+                   f'&age_min={rng.randint(20, 40)}&age_max=70&sort=age',
+            None),
+        'GET /actors/<id>': lambda rng: (
+            'get', f'/actors/{rng.choice(actor_ids)}', None),
+        'GET /search': lambda rng: (
+            'get', f'/search?type=movies&q=Movie {rng.randint(1, 99)}', None),
+        'POST /movies (search)': lambda rng: (
+            'post', '/movies', {'search': f'Movie {rng.randint(1, 99)}'}),
+        'POST /actors (search)': lambda rng: (
+            'post', '/actors', {'search': f'Actor {rng.randint(1, 99)}'}),
+        'POST /movies': lambda rng: (
+            'post', '/movies', {'title': 'Bench', 'release_date': '2020.01.01',
+                                'actors': rng.sample(actor_ids, 2)}),
+        'POST /actors': lambda rng: (
+            'post', '/actors', {'name': 'Bench', 'age': 30,
+                                'gender': 'Female'}),
+        'PATCH /movies/<id>': lambda rng: (
+            'patch', f'/movies/{rng.choice(movie_ids)}',
+            {'title': f'Movie {rng.randint(0, 10 ** 6)}'}),
+        'PATCH /actors/<id>': lambda rng: (
+            'patch', f'/actors/{rng.choice(actor_ids)}',
+            {'age': rng.randint(20, 70)}),
+        'DELETE /movies/<id>': lambda rng: (
+            'delete', f'/movies/{disposable["movies"].pop()}', None),
+        'DELETE /actors/<id>': lambda rng: (
+            'delete', f'/actors/{disposable["actors"].pop()}', None),
+        'POST /movies/bulk': lambda rng: (
+            'post', '/movies/bulk', [{'title': 'Bench bulk',
+                                      'release_date': '2020.01.01'}] * 50),
+        'PATCH /actors/bulk': lambda rng: (
+            'patch', '/actors/bulk', [{'id': actor_id, 'age': 40}
+                                      for actor_id in
+                                      rng.sample(actor_ids, 50)]),
+        'DELETE /actors/bulk': lambda rng: (
+            'delete', '/actors/bulk', [disposable['bulk'].pop()
+                                       for _ in range(10)]),
+        'GET /export/movies': lambda rng: (
+            'get', '/export/movies?links=1', None),
+        'GET /health/pool': lambda rng: (
+            'get', '/health/pool', None),
+    }
+
+
+class QueryCounter:
+    '''
+    Counts the SQL statements run by the current thread.
+    '''
+    def __init__(self):
+        self.local = threading.local()
+        event.listen(Engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    def value(self):
+        return getattr(self.local, 'count', 0)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_scenario(app, build, requests, concurrency, headers, counter, rng):
+    calls = [build(rng) for _ in range(requests)]
+    clients = threading.local()
+
+    def send(call):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        method, url, body = call
+        counter.reset()
+        started = time.perf_counter()
+        response = getattr(clients.client, method)(
+            url, json=body, headers=headers)
+        response.get_data()
+        elapsed = time.perf_counter() - started
+        return elapsed, counter.value(), response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(send, calls))
+    wall = time.perf_counter() - started
+
+    latencies = [elapsed for elapsed, _, _ in results]
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, _, status in results if status >= 400),
+        'rps': requests / wall,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'queries': statistics.mean(queries for _, queries, _ in results)
+    }
+
+
+def regressions(results, baseline, tolerance):
+    '''
+    Returns the (scenario, metric, baseline, current) that got worse
+    than the baseline by more than `tolerance`.
+    '''
+    worse = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if current['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            worse.append((name, 'p95_ms', before['p95_ms'], current['p95_ms']))
+        if current['rps'] < before['rps'] * (1 - tolerance):
+            worse.append((name, 'rps', before['rps'], current['rps']))
+        if current['queries'] > before['queries'] + 0.5:
+            worse.append((name, 'queries', before['queries'],
+                          current['queries']))
+    return worse
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark every endpoint of the API.')
+    parser.add_argument('--database-url', default=None,
+                        help='defaults to a temporary SQLite file')
+    parser.add_argument('--movies', type=int, default=2000)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--cast', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--scenario', action='append', default=None,
+                        help='only run the scenarios containing this text')
+    parser.add_argument('--response-cache', default='none')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='casting-bench-')
+    database_url = args.database_url or \
+        'sqlite:///' + os.path.join(directory, 'bench.sqlite')
+    issuer = LocalIssuer(directory)
+
+    app = create_app({
+        'DATABASE_URL': database_url,
+        'JWKS_URL': issuer.jwks_path,
+        'RESPONSE_CACHE': args.response_cache,
+    })
+    rng = random.Random(args.seed)
+    movie_ids, actor_ids = seed(app, args.movies, args.actors, args.cast, rng)
+    disposable_movies, disposable_actors = seed(
+        app, args.requests, args.requests * 11, 0, rng)
+    disposable = {
+        'movies': disposable_movies,
+        'actors': disposable_actors[:args.requests],
+        'bulk': disposable_actors[args.requests:]
+    }
+
+    headers = {'Authorization': 'Bearer ' + issuer.token()}
+    counter = QueryCounter()
+    results = {}
+    print(f'{"scenario":<24} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"p99 ms":>8} {"queries":>8} {"errors":>7}')
+    for name, build in scenarios(movie_ids, actor_ids, disposable,
+                                 app.config['PER_PAGE']).items():
+        if args.scenario and not any(text in name
+                                     for text in args.scenario):
+            continue
+        result = run_scenario(app, build, args.requests, args.concurrency,
+                              headers, counter, rng)
+        results[name] = result
+        print(f'{name:<24} {result["rps"]:>8.1f} {result["p50_ms"]:>8.2f} '
+              f'{result["p95_ms"]:>8.2f} {result["p99_ms"]:>8.2f} '
+              f'{result["queries"]:>8.1f} {result["errors"]:>7}')
+
+    params = {key: getattr(args, key) for key in
+              ('movies', 'actors', 'cast', 'requests', 'concurrency',
+               'response_cache', 'seed')}
+    params['database'] = database_url.split(':', 1)[0]
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'commit': git_commit(), 'params': params,
+                       'results': results}, f, indent=2, sort_keys=True)
+        print(f'Saved to {args.save}')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['params'] != params:
+            print(f'Warning: baseline parameters differ: {baseline["params"]}')
+        worse = regressions(results, baseline['results'], args.tolerance)
+        print(f'Compared with {baseline["commit"] or args.compare}:')
+        for name, metric, before, after in worse:
+            print(f'  {name}: {metric} {before:.2f} -> {after:.2f}')
+        if worse:
+            sys.exit(1)
+        print('  no regression')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+'''
+Startup time benchmark.
+
+Measures, in fresh interpreters, how long it takes to import the app
+module and to build the app with create_app(), with the schema created
+on startup (DB_CREATE_ALL=1) and left to the migrations
+(DB_CREATE_ALL=0). The JWKS prewarm is disabled so only the app and
+the database are measured. Uses DATABASE_URL from the environment:
+
+  python bench_startup.py --runs 10
+'''
+
+PROBE = '''
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print(json.dumps({'import': imported - started,
+                  'create_app': created - imported}))
+'''
+
+
+def measure(create_all, runs):
+    env = dict(os.environ, DB_CREATE_ALL=create_all, JWKS_PREWARM='0')
+    timings = {'import': [], 'create_app': []}
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE], env=env, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE).stdout
+        for name, seconds in json.loads(output.splitlines()[-1]).items():
+            timings[name].append(seconds)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the import and create_app() times of the app.')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+    if not os.environ.get('DATABASE_URL'):
+        sys.exit('DATABASE_URL is not set.')
+
+    print(f'{"DB_CREATE_ALL":<14} {"import ms":>10} {"create_app ms":>14}')
+    for create_all in ('1', '0'):
+        timings = measure(create_all, args.runs)
+        print(f'{create_all:<14} '
+              f'{statistics.median(timings["import"]) * 1000:>10.1f} '
+              f'{statistics.median(timings["create_app"]) * 1000:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import json
+
+
+'''
+Parsing and validation of the bodies of the bulk endpoints.
+
+Every item is validated before anything is written. Validation returns
+one result per item, in input order, and the rows to write for the
+valid ones; the endpoints fill in the outcome of the write.
+'''
+
+MOVIE_FIELDS = ('title', 'release_date')
+ACTOR_FIELDS = ('name', 'age', 'gender')
+
+
+class BulkError(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def parse_items(request, max_items):
+    '''
+    Reads the items of a bulk request from a JSON array or, with the
+    `application/x-ndjson` content type, from one JSON value per line.
+    '''
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            items = [json.loads(line) for line in
+                     request.get_data(as_text=True).splitlines()
+                     if line.strip()]
+        else:
+            items = json.loads(request.get_data(as_text=True))
+    except ValueError:
+        raise BulkError(400)
+
+    if not isinstance(items, list) or not items:
+        raise BulkError(400)
+    if len(items) > max_items:
+        raise BulkError(413)
+    return items
+
+
+def is_id(value):
+    return type(value) is int
+
+
+def validate_actor_ids(value):
+    return isinstance(value, list) and all(is_id(i) for i in value)
+
+
+def invalid(index, message, **extra):
+    return dict({'index': index, 'status': 'invalid', 'error': message},
+                **extra)
+
+
+def parse_values(values, parsers):
+    '''
+    Converts the `values` that have a parser in `parsers` (a dict of
+    field names to functions raising ValueError), in place. Returns the
+    fields whose value was rejected.
+    '''
+    bad = []
+    for field, parse in (parsers or {}).items():
+        if field in values:
+            try:
+                values[field] = parse(values[field])
+            except ValueError:
+                bad.append(field)
+    return bad
+
+
+def validate_create(items, fields, relations=(), parsers=None):
+    '''
+    Returns (results, rows) for create items. Every field in `fields`
+    is required; `relations` name optional lists of ids that are kept
+    apart from the column values in `row['relations']`. Values are
+    converted with `parsers` (see parse_values).
+    '''
+    results, rows = [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append(invalid(index, 'item must be an object'))
+            continue
+        missing = [field for field in fields if item.get(field) is None]
+        if missing:
+            results.append(invalid(index, 'missing fields',
+                                   fields=missing))
+            continue
+        bad = [name for name in relations
+               if name in item and not validate_actor_ids(item[name])]
+        if bad:
+            results.append(invalid(index, 'invalid ids', fields=bad))
+            continue
+        values = {field: item[field] for field in fields}
+        bad = parse_values(values, parsers)
+        if bad:
+            results.append(invalid(index, 'invalid fields', fields=bad))
+            continue
+        results.append({'index': index, 'status': None})
+        rows.append({
+            'index': index,
+            'values': values,
+            'relations': {name: list(dict.fromkeys(item[name]))
+                          for name in relations if item.get(name)}
+        })
+    return results, rows
+
+
+def validate_update(items, fields, relations=(), parsers=None):
+    '''
+    Returns (results, rows) for update items, which need an `id` and
+    at least one field or relation to change.
+    '''
+    results, rows = [], []
+    seen = set()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not is_id(item.get('id')):
+            results.append(invalid(index, 'item must have an integer id'))
+            continue
+        if item['id'] in seen:
+            results.append(invalid(index, 'duplicate id', id=item['id']))
+            continue
+        values = {field: item[field] for field in fields
+                  if item.get(field)}
+        bad = [name for name in relations
+               if name in item and not validate_actor_ids(item[name])]
+        if bad:
+            results.append(invalid(index, 'invalid ids', id=item['id'],
+                                   fields=bad))
+            continue
+        bad = parse_values(values, parsers)
+        if bad:
+            results.append(invalid(index, 'invalid fields', id=item['id'],
+                                   fields=bad))
+            continue
+        item_relations = {name: list(dict.fromkeys(item[name]))
+                          for name in relations if item.get(name)}
+        if not values and not item_relations:
+            results.append(invalid(index, 'nothing to update',
+                                   id=item['id']))
+            continue
+        seen.add(item['id'])
+        results.append({'index': index, 'id': item['id'], 'status': None})
+        rows.append({'index': index, 'id': item['id'], 'values': values,
+                     'relations': item_relations})
+    return results, rows
+
+
+def validate_delete(items):
+    '''
+    Returns (results, rows) for delete items, given as ids or as
+    objects holding an `id`.
+    '''
+    results, rows = [], []
+    seen = set()
+    for index, item in enumerate(items):
+        if isinstance(item, dict):
+            item = item.get('id')
+        if not is_id(item):
+            results.append(invalid(index, 'item must be an integer id'))
+            continue
+        if item in seen:
+            results.append(invalid(index, 'duplicate id', id=item))
+            continue
+        seen.add(item)
+        results.append({'index': index, 'id': item, 'status': None})
+        rows.append({'index': index, 'id': item})
+    return results, rows
+
+
+def check_existing(results, rows, existing_ids):
+    '''
+    Marks the rows whose id doesn't exist as not found, using a single
+    `existing_ids` call. Returns the rows that exist.
+    '''
+    found = existing_ids([row['id'] for row in rows])
+    valid = []
+    for row in rows:
+        if row['id'] in found:
+            valid.append(row)
+        else:
+            results[row['index']].update(status='not_found',
+                                         error='not found')
+    return valid
+
+
+def check_actor_references(results, rows, missing_ids):
+    '''
+    Resolves the actor ids referenced by all `rows` with a single
+    `missing_ids` call and marks the rows naming unknown actors as
+    invalid. Returns the rows that are still valid.
+    '''
+    referenced = list(dict.fromkeys(
+        actor_id for row in rows
+        for actor_id in row['relations'].get('actors', [])))
+    missing = set(missing_ids(referenced))
+    if not missing:
+        return rows
+
+    valid = []
+    for row in rows:
+        unknown = [actor_id for actor_id in row['relations'].get('actors', [])
+                   if actor_id in missing]
+        if unknown:
+            results[row['index']].update(invalid(
+                row['index'], 'unknown actors', missing_actors=unknown))
+        else:
+            valid.append(row)
+    return valid
+
+
+def chunked(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
@@ -0,0 +1,131 @@
+import zlib
+
+from flask import request
+
+from profiling import timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+'''
+Negotiated compression of the responses.
+
+JSON, NDJSON, CSV and text responses of at least COMPRESS_MIN_SIZE
+bytes are compressed with brotli (when the `brotli` package is
+installed) or gzip, whichever the client's `Accept-Encoding` ranks
+higher, brotli winning ties. Streamed responses (the exports) are
+compressed as they are sent, whatever their size. Every compressible
+response carries `Vary: Accept-Encoding` so shared caches keep the
+encodings apart, and the ETag of a compressed response is made weak:
+the bytes differ from the uncompressed ones, but the `If-None-Match`
+comparison of http_cache still matches either.
+'''
+
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/')
+
+
+class GzipEncoder:
+    name = 'gzip'
+
+    def __init__(self, level):
+        # wbits 31: a deflate stream with the gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    name = 'br'
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def negotiate(accept_encodings, encodings):
+    '''
+    Returns the name of the encoding in `encodings` (in order of
+    preference) with the highest quality in `accept_encodings`, or
+    None when the client accepts none of them.
+    '''
+    best, best_quality = None, 0
+    for name in encodings:
+        quality = accept_encodings.quality(name)
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def compress_stream(chunks, encoder):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = encoder.compress(chunk)
+            if data:
+                yield data
+        yield encoder.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def is_compressible(response):
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if response.direct_passthrough or \
+            'Content-Encoding' in response.headers:
+        return False
+    return (response.mimetype or '').startswith(COMPRESSIBLE)
+
+
+def init_compression(app):
+    if not app.config['COMPRESS']:
+        return
+    encoders = {'gzip': (GzipEncoder, app.config['COMPRESS_LEVEL'])}
+    if brotli is not None:
+        encoders['br'] = (BrotliEncoder, app.config['COMPRESS_BROTLI_LEVEL'])
+    preference = [name for name in ('br', 'gzip') if name in encoders]
+    min_size = app.config['COMPRESS_MIN_SIZE']
+
+    @app.after_request
+    def compress_response(response):
+        if response.status_code == 304:
+            # a 304 carries the headers the 200 would have
+            response.vary.add('Accept-Encoding')
+        if not is_compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(request.accept_encodings, preference)
+        if encoding is None:
+            return response
+        if not response.is_streamed and \
+                response.calculate_content_length() < min_size:
+            return response
+
+        encoder_class, level = encoders[encoding]
+        encoder = encoder_class(level)
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoder)
+            del response.headers['Content-Length']
+        else:
+            with timed('compress'):
+                response.set_data(
+                    encoder.compress(response.get_data()) + encoder.finish())
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,50 @@
+import csv
+import io
+import json
+
+
+'''
+Serializers of the streaming export endpoints. Both turn an iterable
+of row dicts into an iterable of text chunks, one per row, so the
+response can be streamed as the rows are read.
+'''
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def compact_json(row):
+    return json.dumps(row, separators=(',', ':'), default=str) \
+        .encode('utf-8')
+
+
+def ndjson_lines(rows, dumps=compact_json):
+    '''
+    Writes one JSON document per line. `dumps` encodes a row as bytes.
+    '''
+    for row in rows:
+        yield dumps(row) + b'\n'
+
+
+def csv_lines(rows, fields):
+    '''
+    Writes a header line and one line per row. Lists of ids are
+    joined with spaces so each row keeps a single column per field.
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        writer.writerow(values)
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    yield line(fields)
+    for row in rows:
+        yield line([' '.join(str(value) for value in row[field])
+                    if isinstance(row[field], list) else row[field]
+                    for field in fields])
@@ -0,0 +1,30 @@
+import os
+import shutil
+
+from metrics import mark_process_dead
+from models import dispose_engine
+
+
+'''
+gunicorn settings, read from the working directory on startup.
+'''
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+
+def on_starting(server):
+    # metrics files of a previous run would be added to the new totals
+    if METRICS_DIR:
+        shutil.rmtree(METRICS_DIR, ignore_errors=True)
+        os.makedirs(METRICS_DIR)
+
+
+def when_ready(server):
+    # with --preload the app is created in the master: close its
+    # database connections before the workers are forked
+    dispose_engine()
+
+
+def child_exit(server, worker):
+    if METRICS_DIR:
+        mark_process_dead(METRICS_DIR, worker.pid)
@@ -0,0 +1,63 @@
+import hashlib
+from functools import wraps
+from flask import request, make_response, current_app
+
+from models import VERSIONED_TABLES, table_versions
+
+
+'''
+Conditional GET support for the read endpoints.
+
+The ETag of a response is derived from the versions of the tables it
+is built from (see models.TableVersion) and from the requested URL,
+so it changes whenever one of those tables is written to. Clients that
+send a matching `If-None-Match`, or an `If-Modified-Since` no older
+than the last write, get a 304 before the endpoint queries any row.
+'''
+
+
+def compute_etag(versions, path):
+    state = ','.join(f'{name}:{versions[name][0]}'
+                     for name in sorted(versions))
+    return hashlib.sha1(f'{state}|{path}'.encode('utf-8')).hexdigest()
+
+
+def last_modified_of(versions):
+    times = [updated_at for _, updated_at in versions.values()
+             if updated_at is not None]
+    return max(times).replace(microsecond=0) if times else None
+
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def conditional(tables=VERSIONED_TABLES):
+    '''
+    Decorator adding ETag/Last-Modified headers to a read endpoint and
+    answering 304 Not Modified when the client's copy is current.
+    Apply it below `requires_auth` so only authorized clients get 304s.
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions = table_versions(tables)
+            etag = compute_etag(versions, request.full_path)
+            last_modified = last_modified_of(versions)
+
+            if not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return conditional_decorator
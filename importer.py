@@ -0,0 +1,354 @@
+import csv
+import io
+import itertools
+import json
+import os
+import time
+
+import sqlalchemy as sa
+from flask_script import Command, Option
+
+from models import (db, Movie, Actor, actors, bump_versions, adjust_count,
+                    parse_release_date)
+from response_cache import response_cache
+
+
+'''
+Bulk import of movies, actors and movie-actor links from CSV or NDJSON
+files, in the format written by the export endpoints:
+  movies: id, title, release_date (and optionally actor_ids)
+  actors: id, name, age, gender
+  links:  movie_id, actor_id
+The ids are the ids of the source system. Rows are loaded batch by
+batch into a temporary table (with COPY on PostgreSQL, executemany
+elsewhere) and upserted by natural key: (title, release_date) for
+movies and name for actors. The source ids are mapped to the ids they
+got in the `import_staging` table, which is how links are resolved.
+
+Every batch is committed together with its progress in a state file,
+so a crashed import resumes where it stopped. Upserts are idempotent,
+so replaying the last uncommitted batch is safe. Links can only refer
+to movies and actors imported by the same run. Each batch clears the
+response cache, which only reaches the API workers when the cache is
+shared (RESPONSE_CACHE=redis).
+'''
+
+ENTITIES = {
+    'movie': {
+        'model': Movie,
+        'key': ('title', 'release_date'),
+        'fields': ('title', 'release_date'),
+        'integers': (),
+        'dates': ('release_date',)
+    },
+    'actor': {
+        'model': Actor,
+        'key': ('name',),
+        'fields': ('name', 'age', 'gender'),
+        'integers': ('age',),
+        'dates': ()
+    }
+}
+
+staging_metadata = sa.MetaData()
+staging = sa.Table(
+    'import_staging', staging_metadata,
+    sa.Column('kind', sa.String(10), primary_key=True),
+    sa.Column('source_id', sa.BigInteger, primary_key=True),
+    sa.Column('target_id', sa.Integer)
+)
+
+
+def temp_table(name, columns):
+    return sa.Table(name, sa.MetaData(), *columns, prefixes=['TEMPORARY'])
+
+
+def entity_table(kind):
+    spec = ENTITIES[kind]
+    model_table = spec['model'].__table__
+    columns = [model_table.c[field].copy() for field in spec['fields']]
+    return temp_table(f'import_{kind}',
+                      [sa.Column('source_id', sa.BigInteger)] + columns)
+
+
+link_table = temp_table('import_link', [
+    sa.Column('movie_source', sa.BigInteger),
+    sa.Column('actor_source', sa.BigInteger)
+])
+
+
+def read_rows(path):
+    '''
+    Yields the rows of a CSV or NDJSON (.ndjson, .jsonl) file as dicts.
+    '''
+    with open(path, newline='') as f:
+        if path.endswith(('.ndjson', '.jsonl')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for row in csv.DictReader(f):
+                yield {key: (value if value != '' else None)
+                       for key, value in row.items()}
+
+
+def to_int(value):
+    return None if value is None else int(value)
+
+
+def to_date(value):
+    try:
+        return None if value is None else parse_release_date(value)
+    except ValueError:
+        return None
+
+
+def to_ids(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [int(part) for part in value.split()]
+    return [int(part) for part in value]
+
+
+def entity_values(kind, row):
+    '''
+    Returns the values to stage for a movie or actor row, or None when
+    it lacks its id or a natural key field (or its date is invalid).
+    '''
+    spec = ENTITIES[kind]
+    values = {'source_id': to_int(row.get('id'))}
+    for field in spec['fields']:
+        value = row.get(field)
+        if field in spec['integers']:
+            value = to_int(value)
+        elif field in spec['dates']:
+            value = to_date(value)
+        values[field] = value
+    if values['source_id'] is None or \
+            any(values[field] is None for field in spec['key']):
+        return None
+    return values
+
+
+def stage(connection, table, rows):
+    '''
+    Replaces the content of a temporary table with `rows`.
+    '''
+    connection.execute(table.delete())
+    if not rows:
+        return
+    if connection.dialect.name == 'postgresql':
+        columns = [column.name for column in table.columns]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[column] for column in columns])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            f'COPY {table.name} ({", ".join(columns)}) '
+            'FROM STDIN WITH (FORMAT csv)', buffer)
+        cursor.close()
+    else:
+        connection.execute(table.insert(), rows)
+
+
+def upsert_entities(connection, kind, table):
+    '''
+    Upserts the staged rows into the model table by natural key and
+    records the id each source id ended up with.
+    '''
+    spec = ENTITIES[kind]
+    target = spec['model'].__table__
+    bump_versions(target.name, connection=connection)
+    key_match = sa.and_(*[target.c[field] == table.c[field]
+                          for field in spec['key']])
+    others = [field for field in spec['fields'] if field not in spec['key']]
+
+    # when a key appears several times in a batch the last row wins
+    batch = table.alias()
+    if others:
+        last_row = sa.select([sa.func.max(batch.c.source_id)]).where(
+            sa.and_(*[target.c[field] == batch.c[field]
+                      for field in spec['key']])) \
+            .correlate(target).as_scalar()
+        connection.execute(
+            target.update()
+            .where(sa.exists(sa.select([1]).where(key_match)))
+            .values({field: sa.select([table.c[field]])
+                     .where(table.c.source_id == last_row)
+                     .limit(1).as_scalar()
+                     for field in others}))
+
+    last_rows = sa.select([sa.func.max(batch.c.source_id)]) \
+        .group_by(*[batch.c[field] for field in spec['key']])
+    inserted = connection.execute(target.insert().from_select(
+        list(spec['fields']),
+        sa.select([table.c[field] for field in spec['fields']])
+        .where(table.c.source_id.in_(last_rows))
+        .where(~sa.exists(sa.select([1]).select_from(target)
+                          .where(key_match)))))
+    adjust_count(target.name, inserted.rowcount, connection=connection)
+
+    connection.execute(staging.delete().where(sa.and_(
+        staging.c.kind == kind,
+        staging.c.source_id.in_(sa.select([table.c.source_id])))))
+    connection.execute(staging.insert().from_select(
+        ['kind', 'source_id', 'target_id'],
+        sa.select([sa.literal(kind), table.c.source_id,
+                   sa.select([sa.func.min(target.c.id)])
+                   .where(key_match).as_scalar()])
+        .distinct()))
+
+
+def insert_links(connection):
+    '''
+    Inserts the staged links whose movie and actor were imported,
+    skipping the ones that already exist.
+    '''
+    movie = staging.alias()
+    actor = staging.alias()
+    movie_of_link = sa.and_(movie.c.kind == 'movie',
+                            movie.c.source_id == link_table.c.movie_source)
+    actor_of_link = sa.and_(actor.c.kind == 'actor',
+                            actor.c.source_id == link_table.c.actor_source)
+    links = sa.select([movie.c.target_id, actor.c.target_id]).distinct() \
+        .select_from(link_table.join(movie, movie_of_link)
+                     .join(actor, actor_of_link)) \
+        .where(~sa.exists(sa.select([1]).select_from(actors).where(sa.and_(
+            actors.c.movie_id == movie.c.target_id,
+            actors.c.actor_id == actor.c.target_id))))
+    connection.execute(actors.insert().from_select(['movie_id', 'actor_id'],
+                                                   links))
+    bump_versions('actors', connection=connection)
+
+
+class ImportState:
+    '''
+    Number of rows of each (phase, file) already committed,
+    persisted as JSON after every batch.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = json.load(f)
+
+    def key(self, phase, path):
+        return f'{phase}:{os.path.abspath(path)}'
+
+    def get(self, phase, path):
+        return self.done.get(self.key(phase, path), 0)
+
+    def set(self, phase, path, rows):
+        self.done[self.key(phase, path)] = rows
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.done, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ImportCommand(Command):
+    '''
+    Bulk-loads movies, actors and movie-actor links from CSV or NDJSON
+    files, resuming an interrupted import from its state file.
+    '''
+    option_list = (
+        Option('--movies', dest='movies', default=None),
+        Option('--actors', dest='actors', default=None),
+        Option('--links', dest='links', default=None),
+        Option('--batch-size', dest='batch_size', type=int, default=5000),
+        Option('--state', dest='state', default='.import-state.json'),
+    )
+
+    def run(self, movies, actors, links, batch_size, state):
+        if not (movies or actors or links):
+            print('Nothing to import: pass --movies, --actors or --links.')
+            return
+        self.state = ImportState(state)
+        self.batch_size = batch_size
+
+        connection = db.engine.connect()
+        try:
+            staging.create(connection, checkfirst=True)
+            entity_tables = {kind: entity_table(kind) for kind in ENTITIES}
+            for table in list(entity_tables.values()) + [link_table]:
+                table.create(connection)
+
+            if movies:
+                self.load(connection, 'movie', movies,
+                          lambda rows: self.entities(
+                              connection, 'movie', entity_tables['movie'],
+                              rows))
+            if actors:
+                self.load(connection, 'actor', actors,
+                          lambda rows: self.entities(
+                              connection, 'actor', entity_tables['actor'],
+                              rows))
+            if movies:
+                self.load(connection, 'movie_link', movies,
+                          lambda rows: self.links(connection, [
+                              {'movie_source': to_int(row.get('id')),
+                               'actor_source': actor_id}
+                              for row in rows
+                              for actor_id in to_ids(row.get('actor_ids'))]))
+            if links:
+                self.load(connection, 'link', links,
+                          lambda rows: self.links(connection, [
+                              {'movie_source': to_int(row.get('movie_id')),
+                               'actor_source': to_int(row.get('actor_id'))}
+                              for row in rows]))
+
+            staging.drop(connection)
+            self.state.finish()
+        finally:
+            connection.close()
+
+    def entities(self, connection, kind, table, rows):
+        values = [entity_values(kind, row) for row in rows]
+        values = [value for value in values if value is not None]
+        stage(connection, table, values)
+        upsert_entities(connection, kind, table)
+        return len(rows) - len(values)
+
+    def links(self, connection, rows):
+        rows = [row for row in rows
+                if row['movie_source'] is not None and
+                row['actor_source'] is not None]
+        stage(connection, link_table, rows)
+        insert_links(connection)
+        return 0
+
+    def load(self, connection, phase, path, write):
+        '''
+        Feeds the rows of `path` to `write` batch by batch, committing
+        each batch with its progress. Reports rows/sec as it goes.
+        '''
+        done = self.state.get(phase, path)
+        rows = itertools.islice(read_rows(path), done, None)
+        if done:
+            print(f'{phase}: resuming {path} after {done} rows')
+
+        started = time.monotonic()
+        imported = skipped = 0
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            with connection.begin():
+                skipped += write(batch)
+            # batches touch arbitrary rows, drop the whole response cache
+            response_cache.clear()
+            imported += len(batch)
+            self.state.set(phase, path, done + imported)
+            rate = imported / max(time.monotonic() - started, 1e-9)
+            print(f'{phase}: {done + imported} rows ({rate:.0f} rows/sec)')
+
+        if skipped:
+            print(f'{phase}: skipped {skipped} rows without id or key '
+                  f'(or with an invalid date)')
@@ -1,13 +1,29 @@
-from flask_script import Manager
+from flask_script import Manager, Command
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, reconcile_counts
+from importer import ImportCommand
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
+
+class ReconcileCountsCommand(Command):
+    '''
+    Recounts movies and actors and repairs the maintained totals.
+    '''
+    def run(self):
+        fixed = reconcile_counts()
+        for name, (stored, actual) in sorted(fixed.items()):
+            print(f'{name}: {stored} -> {actual}')
+        if not fixed:
+            print('Row counts are correct.')
+
+
 manager.add_command('db', MigrateCommand)
+manager.add_command('import', ImportCommand())
+manager.add_command('reconcile_counts', ReconcileCountsCommand())
 
 
 if __name__ == '__main__':
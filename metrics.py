@@ -0,0 +1,326 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+from flask import g, request
+
+from auth import token_cache
+from models import pool_stats
+from response_cache import response_cache
+
+
+'''
+Prometheus metrics, served in the text exposition format by
+`GET /metrics`.
+
+Every worker counts requests by route, method and status, the time it
+took to build their responses, and the requests `requires_auth`
+rejected by AuthError code, in memory under one short lock. The state
+of the database pool and the hit and miss counts of the response and
+token caches are read from their own counters when the metrics are
+collected, so they cost nothing per request.
+
+With several worker processes, set METRICS_DIR to a directory shared
+by the workers (and emptied before the server starts). Each worker
+then writes its metrics to `<pid>.json` in it every
+METRICS_FLUSH_SECONDS from a background thread, and `/metrics`, on
+whichever worker serves it, adds up the files of every worker. The
+counters of workers that exited are kept, so the totals never go
+backwards; the pool gauges only include running workers.
+'''
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    'http_requests_total': (
+        'counter', 'Requests served, by route, method and status.'),
+    'http_request_duration_seconds': (
+        'histogram', 'Time to build the response, by route and method.'),
+    'auth_failures_total': (
+        'counter', 'Requests rejected by requires_auth, by AuthError code.'),
+    'db_pool_size': (
+        'gauge', 'Connections kept open by the database pool.'),
+    'db_pool_connections': (
+        'gauge', 'Connections of the database pool, by state.'),
+    'db_pool_checkouts_total': (
+        'counter', 'Connections checked out of the database pool.'),
+    'db_pool_timeouts_total': (
+        'counter', 'Checkouts that timed out waiting for a connection.'),
+    'db_pool_wait_seconds_total': (
+        'counter', 'Time spent waiting for a connection.'),
+    'response_cache_requests_total': (
+        'counter', 'Response cache lookups, by result.'),
+    'token_cache_requests_total': (
+        'counter', 'Verified token cache lookups, by result.'),
+}
+
+ARCHIVE = 'archive.json'
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self.directory = None
+        self.flush_seconds = 1.0
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    def configure(self, directory=None, flush_seconds=1.0, collectors=()):
+        '''
+        `collectors` are functions returning (name, labels, value)
+        tuples, called whenever the metrics are collected.
+        '''
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.collectors = list(collectors)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        self._start_flusher()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = next((i for i, bound in enumerate(BUCKETS)
+                       if value <= bound), len(BUCKETS))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # counts per bucket (the last one is +Inf), sum, count
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 3)
+            histogram[bucket] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+        self._start_flusher()
+
+    def samples(self):
+        '''
+        Returns the metrics of this process as a list of
+        [name, labels, value] (a list of bucket counts, sum and count
+        for histograms).
+        '''
+        with self._lock:
+            samples = [[name, list(labels), value] for (name, labels), value
+                       in self.counters.items()]
+            samples += [[name, list(labels), list(value)] for
+                        (name, labels), value in self.histograms.items()]
+        for collect in self.collectors:
+            samples += [[name, sorted(labels.items()), value]
+                        for name, labels, value in collect()]
+        return samples
+
+    def flush(self):
+        '''
+        Writes the metrics of this process to `<pid>.json`, replacing
+        the file atomically so readers never see a partial one. The
+        directory is created again if it was removed (e.g. by a cleaner
+        of /tmp); the other workers write theirs on their next flush.
+        '''
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        temporary = path + '.tmp'
+        try:
+            f = open(temporary, 'w')
+        except FileNotFoundError:
+            os.makedirs(self.directory, exist_ok=True)
+            f = open(temporary, 'w')
+        with f:
+            json.dump(self.samples(), f)
+        os.replace(temporary, path)
+
+    def _start_flusher(self):
+        # threads don't survive a fork, so each worker starts its own
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+        atexit.register(self._flush_quietly)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self._flush_quietly()
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except OSError:
+            # e.g. the directory isn't writable; /metrics reports it
+            pass
+
+    def collect(self):
+        '''
+        Returns the samples of every worker added up, or of this
+        process only when no METRICS_DIR is set.
+        '''
+        if not self.directory:
+            return merge({}, self.samples())
+        self.flush()
+        totals = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            samples = read_samples(os.path.join(self.directory, filename))
+            if filename != ARCHIVE and \
+                    not is_running(int(filename[:-len('.json')])):
+                samples = [sample for sample in samples
+                           if METRICS[sample[0]][0] != 'gauge']
+            merge(totals, samples)
+        return totals
+
+    def render(self):
+        return render(self.collect())
+
+
+def read_samples(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(totals, samples):
+    for name, labels, value in samples:
+        key = (name, tuple(tuple(label) for label in labels))
+        if isinstance(value, list):
+            total = totals.setdefault(key, [0] * len(value))
+            for i, count in enumerate(value):
+                total[i] += count
+        else:
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def mark_process_dead(directory, pid):
+    '''
+    Folds the counters of an exited worker into `archive.json`, so the
+    directory doesn't grow with every worker restart. Called by the
+    gunicorn master, which is the only writer of the archive.
+    '''
+    path = os.path.join(directory, f'{pid}.json')
+    samples = [sample for sample in read_samples(path)
+               if METRICS[sample[0]][0] != 'gauge']
+    if not samples:
+        return
+    archive = os.path.join(directory, ARCHIVE)
+    totals = merge(merge({}, read_samples(archive)), samples)
+    temporary = archive + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump([[name, list(labels), value] for (name, labels), value
+                   in totals.items()], f)
+    os.replace(temporary, archive)
+    os.remove(path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+               .replace('"', '\\"') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value
+                          in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(totals):
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        series = sorted((labels, value) for (metric, labels), value
+                        in totals.items() if metric == name)
+        if not series:
+            continue
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in series:
+            if kind != 'histogram':
+                lines.append(
+                    f'{name}{format_labels(labels)} {format_value(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value[:-2]):
+                cumulative += count
+                lines.append(f'{name}_bucket'
+                             f'{format_labels(labels + (("le", bound),))} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} '
+                         f'{format_value(value[-2])}')
+            lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def cache_samples():
+    for name, stats in (('response_cache_requests_total',
+                         response_cache.stats()),
+                        ('token_cache_requests_total', token_cache.stats())):
+        yield name, {'result': 'hit'}, stats['hits']
+        yield name, {'result': 'miss'}, stats['misses']
+
+
+def init_metrics(app):
+    '''
+    Counts the requests of `app` in `metrics`, along with the state of
+    its database pool and of the caches.
+    '''
+    def pool_samples():
+        # may run in the flushing thread, outside of any request
+        with app.app_context():
+            stats = pool_stats()
+        yield 'db_pool_checkouts_total', {}, stats['checkouts']
+        yield 'db_pool_timeouts_total', {}, stats['timeouts']
+        yield 'db_pool_wait_seconds_total', {}, stats['wait_seconds']
+        if 'size' in stats:
+            yield 'db_pool_size', {}, stats['size']
+            yield 'db_pool_connections', {'state': 'in_use'}, stats['in_use']
+            yield 'db_pool_connections', {'state': 'idle'}, stats['idle']
+
+    metrics.configure(app.config['METRICS_DIR'],
+                      app.config['METRICS_FLUSH_SECONDS'],
+                      [pool_samples, cache_samples])
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def count_request(response):
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.inc('http_requests_total', route=route,
+                    method=request.method, status=str(response.status_code))
+        metrics.observe('http_request_duration_seconds',
+                        time.perf_counter() - started,
+                        route=route, method=request.method)
+        return response
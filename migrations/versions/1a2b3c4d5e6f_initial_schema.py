@@ -0,0 +1,53 @@
+"""initial schema
+
+Revision ID: 1a2b3c4d5e6f
+Revises: 
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a2b3c4d5e6f'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases created by db.create_all() already have these tables
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'movie' not in tables:
+        op.create_table(
+            'movie',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(), nullable=True),
+            sa.Column('release_date', sa.String(length=120), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'actor' not in tables:
+        op.create_table(
+            'actor',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=120), nullable=True),
+            sa.Column('age', sa.Integer(), nullable=True),
+            sa.Column('gender', sa.String(length=120), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'actors' not in tables:
+        op.create_table(
+            'actors',
+            sa.Column('movie_id', sa.Integer(), nullable=False),
+            sa.Column('actor_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['actor_id'], ['actor.id'], ),
+            sa.ForeignKeyConstraint(['movie_id'], ['movie.id'], ),
+            sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+        )
+
+
+def downgrade():
+    op.drop_table('actors')
+    op.drop_table('actor')
+    op.drop_table('movie')
@@ -0,0 +1,42 @@
+"""trigram and full-text search indexes
+
+Revision ID: 2b3c4d5e6f70
+Revises: 1a2b3c4d5e6f
+Create Date: 2026-10-18 09:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2b3c4d5e6f70'
+down_revision = '1a2b3c4d5e6f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the indexes rely on PostgreSQL extensions; other backends
+    # keep searching with a plain LIKE scan
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_movie_title_trgm '
+               'ON movie USING gin (title gin_trgm_ops)')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_actor_name_trgm '
+               'ON actor USING gin (name gin_trgm_ops)')
+    op.execute("CREATE INDEX IF NOT EXISTS ix_movie_title_fts "
+               "ON movie USING gin (to_tsvector('simple', "
+               "coalesce(title, '')))")
+    op.execute("CREATE INDEX IF NOT EXISTS ix_actor_name_fts "
+               "ON actor USING gin (to_tsvector('simple', "
+               "coalesce(name, '')))")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('DROP INDEX IF EXISTS ix_actor_name_fts')
+    op.execute('DROP INDEX IF EXISTS ix_movie_title_fts')
+    op.execute('DROP INDEX IF EXISTS ix_actor_name_trgm')
+    op.execute('DROP INDEX IF EXISTS ix_movie_title_trgm')
@@ -0,0 +1,35 @@
+"""maintained row counts of movies and actors
+
+Revision ID: 4d5e6f708192
+Revises: 3c4d5e6f7081
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d5e6f708192'
+down_revision = '3c4d5e6f7081'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'row_count' in tables:
+        return
+    op.create_table(
+        'row_count',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('count', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    for name in ('movie', 'actor'):
+        op.execute(f"INSERT INTO row_count (name, count) "
+                   f"SELECT '{name}', COUNT(*) FROM {name}")
+
+
+def downgrade():
+    op.drop_table('row_count')
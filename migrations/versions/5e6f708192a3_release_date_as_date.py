@@ -0,0 +1,116 @@
+"""release_date as a date column, with filter and sort indexes
+
+Revision ID: 5e6f708192a3
+Revises: 4d5e6f708192
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e6f708192a3'
+down_revision = '4d5e6f708192'
+branch_labels = None
+depends_on = None
+
+# the formats release dates were stored in as text
+FORMATS = ('%Y-%m-%d', '%Y.%m.%d', '%Y/%m/%d', '%d.%m.%Y',
+           '%B %d, %Y', '%b %d, %Y')
+
+# B-tree indexes of the filters and sorts of the list endpoints
+INDEXES = {
+    'ix_movie_release_date_id': 'movie (release_date, id)',
+    'ix_movie_title_id': 'movie (title, id)',
+    'ix_actor_gender_age_id': 'actor (lower(gender), age, id)',
+    'ix_actor_age_id': 'actor (age, id)',
+    'ix_actor_name_id': 'actor (name, id)',
+}
+
+movie = sa.table('movie',
+                 sa.column('release_date', sa.String),
+                 sa.column('release_day', sa.Date))
+table_version = sa.table('table_version',
+                         sa.column('name', sa.String),
+                         sa.column('version', sa.BigInteger),
+                         sa.column('updated_at', sa.DateTime))
+
+
+def parse(value):
+    for date_format in FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            pass
+    return None
+
+
+def upgrade():
+    bind = op.get_bind()
+    columns = {column['name']: column['type']
+               for column in sa.inspect(bind).get_columns('movie')}
+    # databases created by db.create_all() already have a date column
+    if not isinstance(columns['release_date'], sa.Date):
+        op.add_column('movie', sa.Column('release_day', sa.Date(),
+                                         nullable=True))
+        # one UPDATE per distinct text value, parsed here as the
+        # formats are mixed; values no format matches become NULL
+        days, unparsed = [], []
+        for (value,) in bind.execute(
+                sa.select([movie.c.release_date]).distinct()):
+            if value is None:
+                continue
+            day = parse(value)
+            if day is None:
+                unparsed.append(value)
+            else:
+                days.append({'value': value, 'day': day})
+        if days:
+            bind.execute(
+                movie.update()
+                .where(movie.c.release_date == sa.bindparam('value'))
+                .values(release_day=sa.bindparam('day')), days)
+        if unparsed:
+            print(f'{len(unparsed)} release dates could not be parsed '
+                  f'and were set to NULL: {unparsed[:20]}')
+
+        with op.batch_alter_table('movie') as batch:
+            batch.drop_column('release_date')
+            batch.alter_column('release_day', new_column_name='release_date')
+        # the dates of the responses change format, so the ETags of
+        # cached copies must change too
+        op.execute(table_version.update()
+                   .where(table_version.c.name == 'movie')
+                   .values(version=table_version.c.version + 1,
+                           updated_at=datetime.utcnow()))
+
+    # db.create_all() may have created them already
+    for name, columns in INDEXES.items():
+        op.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {columns}')
+
+
+def downgrade():
+    bind = op.get_bind()
+    for name in INDEXES:
+        op.execute(f'DROP INDEX IF EXISTS {name}')
+
+    op.add_column('movie', sa.Column('release_text', sa.String(length=120),
+                                     nullable=True))
+    text = sa.table('movie',
+                    sa.column('release_date', sa.Date),
+                    sa.column('release_text', sa.String))
+    days = [{'day': day, 'text': day.strftime('%Y.%m.%d')}
+            for (day,) in bind.execute(
+                sa.select([text.c.release_date]).distinct())
+            if day is not None]
+    if days:
+        bind.execute(
+            text.update()
+            .where(text.c.release_date == sa.bindparam('day'))
+            .values(release_text=sa.bindparam('text')), days)
+    with op.batch_alter_table('movie') as batch:
+        batch.drop_column('release_date')
+        batch.alter_column('release_text', new_column_name='release_date')
@@ -1,22 +1,414 @@
+import logging
 import os
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import time
+from datetime import date, datetime
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
+from sqlalchemy import create_engine, event, exc, func, or_
+from sqlalchemy.orm import joinedload, load_only, selectinload, sessionmaker
+from sqlalchemy.pool import Pool, QueuePool
+from sqlalchemy.sql.dml import UpdateBase
 
 
-DATABASE_URL = os.environ['DATABASE_URL']
-db = SQLAlchemy()
+logger = logging.getLogger(__name__)
+
+
+class RoutingSession(SignallingSession):
+    '''
+    Session sending the reads of GET requests to a replica (see
+    Read replicas below) and everything else to the primary.
+    '''
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase) or \
+                not reads_from_replica():
+            return super().get_bind(mapper, clause)
+        # one replica per session, so a request reads a single snapshot
+        if 'replica' not in self.info:
+            self.info['replica'] = replicas.choose()
+        return self.info['replica'] or super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+# databases whose tables this process already created
+prepared_databases = set()
 
 '''
 setup_db(app)
-  binds a flask application and a SQLAlchemy service
+  binds a flask application and a SQLAlchemy service. The database is
+  `database_path`, else the app's DATABASE_URL setting, else the
+  DATABASE_URL environment variable, read when the app is set up rather
+  than when this module is imported. Unless DB_CREATE_ALL is False,
+  missing tables are created (along with the pg_trgm extension search
+  ranks with, on PostgreSQL) and their version and count rows seeded,
+  once per database and process. With DB_CREATE_ALL False the schema
+  is left to the migrations and no query runs at startup.
 '''
-def setup_db(app, database_path=DATABASE_URL):
+def setup_db(app, database_path=None):
+    if database_path is None:
+        database_path = app.config.get('DATABASE_URL') or \
+            os.environ.get('DATABASE_URL')
+    if not database_path:
+        raise RuntimeError('DATABASE_URL is not set.')
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
     migrate = Migrate(app, db)
-    db.create_all()
+    replicas.configure(app.config.get('DATABASE_REPLICA_URLS', ()),
+                       app.config.get('REPLICA_RETRY_SECONDS', 30))
+    replicas.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', 5)
+    last_write_window.clear()
+    if replicas.engines:
+        keep_last_write(replicas.sticky_seconds)
+    app.after_request(remember_write)
+    if app.config.get('DB_CREATE_ALL', True) and \
+            database_path not in prepared_databases:
+        # in an app context, so the session is this app's and is
+        # removed afterwards
+        with app.app_context():
+            create_extensions()
+            db.create_all()
+            seed_table_versions()
+            seed_row_counts()
+        prepared_databases.add(database_path)
+
+
+def create_extensions():
+    if db.engine.dialect.name != 'postgresql':
+        return
+    try:
+        with db.engine.connect() as connection:
+            connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except exc.DBAPIError:
+        # e.g. the role may not create extensions: search then ranks
+        # without trigram similarity
+        logger.warning('Unable to create the pg_trgm extension',
+                       exc_info=True)
+
+
+# Connection pool
+#   configured with environment variables (PostgreSQL only; SQLite keeps
+#   the pool SQLAlchemy picks for it):
+#   - DB_POOL_SIZE: connections kept open per worker (default 5).
+#   - DB_MAX_OVERFLOW: extra connections opened under bursts (default 10).
+#   - DB_POOL_TIMEOUT: seconds a request waits for a free connection
+#     before failing (default 30).
+#   - DB_POOL_RECYCLE: seconds after which a connection is replaced
+#     (default 1800, -1 to never recycle).
+#   - DB_POOL_PRE_PING: `1` (default) tests connections on checkout, so
+#     connections broken by a failover are replaced instead of failing
+#     the request.
+#   - DB_STATEMENT_TIMEOUT: milliseconds after which PostgreSQL cancels
+#     a statement (default 0, no limit).
+#   Checkout wait times and timeouts are recorded in `pool_metrics`.
+def engine_options(database_path):
+    if database_path.startswith('sqlite'):
+        return {}
+    options = {
+        'poolclass': MeteredQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+    statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+    if statement_timeout:
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={statement_timeout}'
+        }
+    return options
+
+
+class PoolMetrics:
+    '''
+    Counters of connection checkouts: how many, how long requests
+    waited for a connection (total and worst) and how many gave up
+    after DB_POOL_TIMEOUT.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+
+    def observe(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(QueuePool):
+    '''
+    QueuePool recording how long every checkout waited in `pool_metrics`.
+    '''
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.timeout()
+            raise
+        pool_metrics.observe(time.perf_counter() - started)
+        return connection
+
+
+def pool_stats():
+    '''
+    Returns the state of the connection pool of this worker along with
+    the checkout metrics.
+    '''
+    pool = db.engine.pool
+    stats = {
+        'checkouts': pool_metrics.checkouts,
+        'timeouts': pool_metrics.timeouts,
+        'wait_seconds': pool_metrics.wait_seconds,
+        'max_wait_seconds': pool_metrics.max_wait_seconds,
+    }
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'in_use': pool.checkedout(),
+            'idle': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+        })
+    return stats
+
+
+# Fork safety
+#   a connection is only handed out in the process that opened it. When
+#   gunicorn preloads the app, connections opened in the master would
+#   otherwise be shared by every worker it forks. Connections of another
+#   process are dropped without being closed, since closing them would
+#   also end the session of the process that owns them.
+#   dispose_engine() closes the connections of the current process, and
+#   runs in the master before the workers are forked (gunicorn.conf.py).
+@event.listens_for(Pool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f'Connection opened by process {connection_record.info["pid"]} '
+            f'checked out in process {pid}')
+
+
+def dispose_engine():
+    if db.app is not None:
+        db.get_engine(db.app).dispose()
+    for engine in replicas.engines:
+        engine.dispose()
+
+
+# Read replicas
+#   with DATABASE_REPLICA_URLS set, the reads of GET requests go to the
+#   replicas in turn and writes, as well as all other requests, to the
+#   primary. A replica whose connection fails is skipped for
+#   REPLICA_RETRY_SECONDS; the request that hit the failure still fails.
+#   When no replica is healthy reads go to the primary.
+#   Read-your-writes: a request that commits sets a `last_write` cookie
+#   and for REPLICA_STICKY_SECONDS afterwards the GET requests carrying
+#   it read from the primary, so a client sees its own writes even when
+#   the replicas lag behind. The response cache relies on the same
+#   cookie (see keep_last_write).
+class ReplicaSet:
+    def __init__(self):
+        self.engines = []
+        self.retry_seconds = 30
+        self.sticky_seconds = 5
+        self._ejected_until = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def configure(self, urls, retry_seconds=30):
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = [create_engine(url, **engine_options(url))
+                        for url in urls]
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self.handle_error)
+        self.retry_seconds = retry_seconds
+        self._ejected_until = {}
+        self._next = 0
+
+    def choose(self):
+        '''
+        Returns the next healthy replica, or None when there is none.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.engines)):
+                engine = self.engines[self._next % len(self.engines)]
+                self._next += 1
+                if self._ejected_until.get(engine, 0) <= now:
+                    return engine
+        return None
+
+    def eject(self, engine):
+        with self._lock:
+            self._ejected_until[engine] = \
+                time.monotonic() + self.retry_seconds
+
+    def handle_error(self, context):
+        # lost or refused connections, not errors of the statement
+        if context.is_disconnect or context.connection is None:
+            self.eject(context.engine)
+
+
+replicas = ReplicaSet()
+
+
+# how long the `last_write` cookie is kept, the longest of the
+# windows its readers asked for with keep_last_write()
+last_write_window = []
+
+
+def keep_last_write(seconds):
+    '''
+    Makes the `last_write` cookie last at least `seconds`, for code
+    that needs to recognize the clients that wrote recently.
+    '''
+    if seconds > 0:
+        last_write_window.append(seconds)
+
+
+def last_write_age():
+    '''
+    Returns the seconds since the client of the current request last
+    wrote, according to its `last_write` cookie, or None.
+    '''
+    last_write = request.cookies.get('last_write', type=float)
+    if last_write is None:
+        return None
+    return max(time.time() - last_write, 0.0)
+
+
+def reads_from_replica():
+    if not replicas.engines or not has_request_context() or \
+            request.method not in ('GET', 'HEAD') or g.get('db_wrote'):
+        return False
+    age = last_write_age()
+    return age is None or age > replicas.sticky_seconds
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def flag_write(session):
+    if has_request_context():
+        g.db_wrote = True
+
+
+def remember_write(response):
+    if g.get('db_wrote') and last_write_window:
+        response.set_cookie('last_write', str(time.time()),
+                            max_age=max(last_write_window),
+                            httponly=True, samesite='Lax')
+    return response
+
+
+# Relationship loading
+#   relationships are lazy and only loaded when an endpoint asks for them,
+#   so counts, deletes and other paths that never format a row don't pay
+#   for them. Endpoints that format rows start from:
+#   - Model.list_query(): relationships are loaded with one extra IN
+#     query per relationship for the whole page, so the number of queries
+#     doesn't depend on the page size.
+#   - Model.detail_query(): relationships are loaded with a JOIN in the
+#     same query, for single-row lookups.
+#   Both take a Projection, which narrows the columns selected and the
+#   relationship loaded to what the response carries.
+class Projection:
+    '''
+    What a response carries of the rows of `model`: its `fields`
+    (columns of model.FIELDS, the id always included) and, when
+    `include` names its relationship, the related rows in their short
+    form. Queries select only those columns and only load the
+    relationship when it is included, so a projection without it never
+    reads the `actors` association table.
+    '''
+    def __init__(self, model, fields=None, include=None):
+        self.model = model
+        self.fields = tuple(dict.fromkeys(('id',) + tuple(fields or
+                                                          model.FIELDS)))
+        self.include = include
+
+    @property
+    def related(self):
+        return getattr(self.model, self.include).property.mapper \
+            .class_.projection()
+
+    def options(self, joined=False):
+        options = [load_only(*self.fields)]
+        if self.include:
+            loader = joinedload if joined else selectinload
+            options.append(loader(getattr(self.model, self.include))
+                           .load_only(*self.related.fields))
+        return options
+
+    def query(self, joined=False):
+        return self.model.query.options(*self.options(joined))
+
+    def format(self, row):
+        data = {name: getattr(row, name) for name in self.fields}
+        if self.include:
+            related = self.related
+            data[self.include] = [related.format(item) for item
+                                  in getattr(row, self.include)]
+        return data
+
+
+class Projected:
+    '''
+    Formatting of the rows of a model. FIELDS are the columns a response
+    may carry and RELATIONSHIP the related rows it may embed: format()
+    carries all of them, short_format() no related rows.
+    '''
+    @classmethod
+    def projection(cls, fields=None, include=None):
+        return Projection(cls, fields, include)
+
+    @classmethod
+    def full_projection(cls):
+        return cls.projection(include=cls.RELATIONSHIP)
+
+    @classmethod
+    def list_query(cls, projection=None):
+        return (projection or cls.full_projection()).query()
+
+    @classmethod
+    def detail_query(cls, projection=None):
+        return (projection or cls.full_projection()).query(joined=True)
+
+    def format(self):
+        return self.full_projection().format(self)
+
+    def short_format(self):
+        return self.projection().format(self)
 
 
 actors = db.Table(
@@ -26,76 +418,531 @@ actors = db.Table(
 )
 
 
-class Actor(db.Model):
+class Actor(Projected, db.Model):
+    FIELDS = ('id', 'name', 'gender', 'age')
+    RELATIONSHIP = 'movies'
+    SORTS = ('id', 'name', 'age')
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120))
     age = db.Column(db.Integer)
     gender = db.Column(db.String(120))
 
+    __table_args__ = (
+        db.Index('ix_actor_gender_age_id', func.lower(gender), age, id),
+        db.Index('ix_actor_age_id', age, id),
+        db.Index('ix_actor_name_id', name, id),
+    )
+
     def __repr__(self):
         return self.name
 
+    @classmethod
+    def missing_ids(cls, ids):
+        '''
+        Returns the ids in `ids` that don't belong to any actor,
+        using a single IN query.
+        '''
+        found = existing_ids(cls, ids)
+        return [actor_id for actor_id in ids if actor_id not in found]
+
     def insert(self):
         db.session.add(self)
+        bump_versions('actor')
+        adjust_count('actor', 1)
+        invalidate('actors')
         db.session.commit()
 
     def update(self):
+        bump_versions('actor')
+        # the change may move the actor in or out of filtered and
+        # sorted pages
+        invalidate(f'actor:{self.id}', 'actors')
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_versions('actor', 'actors')
+        adjust_count('actor', -1)
+        invalidate(f'actor:{self.id}', 'actors')
         db.session.commit()
 
-    def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'gender': self.gender,
-            'age': self.age,
-            'movies': [movie.short_format() for movie in self.movies]
-        }
-
-    def short_format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'gender': self.gender,
-            'age': self.age,
-        }
 
+class Movie(Projected, db.Model):
+    FIELDS = ('id', 'title', 'release_date')
+    RELATIONSHIP = 'actors'
+    SORTS = ('id', 'title', 'release_date')
 
-class Movie(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String())
-    release_date = db.Column(db.String(120))
-    actors = db.relationship('Actor', secondary=actors, lazy='subquery',
-                             backref=db.backref('movies', lazy=True))
+    release_date = db.Column(db.Date)
+    actors = db.relationship('Actor', secondary=actors, lazy='select',
+                             backref=db.backref('movies', lazy='select'))
+
+    __table_args__ = (
+        db.Index('ix_movie_release_date_id', release_date, id),
+        db.Index('ix_movie_title_id', title, id),
+    )
 
     def __repr__(self):
         return self.title
 
     def insert(self):
         db.session.add(self)
+        bump_versions('movie')
+        adjust_count('movie', 1)
+        invalidate('movies')
         db.session.commit()
 
     def update(self):
+        bump_versions('movie')
+        invalidate(f'movie:{self.id}', 'movies')
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_versions('movie', 'actors')
+        adjust_count('movie', -1)
+        invalidate(f'movie:{self.id}', 'movies')
         db.session.commit()
 
-    def format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date,
-            'actors': [actor.short_format() for actor in self.actors]
-        }
+    def set_actors(self, actor_ids):
+        '''
+        Replaces the cast of the movie with one bulk insert into the
+        `actors` association table. The ids must already be validated
+        with Actor.missing_ids(). Changes are committed by insert/update.
+        '''
+        db.session.add(self)
+        if self.id is None:
+            db.session.flush()
+        else:
+            invalidate(*[f'actor:{actor_id}'
+                         for actor_id in linked_ids([self.id])])
+            db.session.execute(
+                actors.delete().where(actors.c.movie_id == self.id))
+        invalidate(f'movie:{self.id}',
+                   *[f'actor:{actor_id}' for actor_id in actor_ids])
+        if actor_ids:
+            db.session.execute(actors.insert(), [
+                {'movie_id': self.id, 'actor_id': actor_id}
+                for actor_id in actor_ids
+            ])
+        bump_versions('actors')
+        db.session.expire(self, ['actors'])
 
-    def short_format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date
-        }
+
+'''
+parse_release_date(value)
+  returns the date written in `value`, in ISO 8601 (`2020-08-09`, the
+  format of the responses) or one of the formats the API used to store
+  as text (`2020.08.09`, `2020/08/09`, `09.08.2020`, `August 9, 2020`).
+  Raises ValueError for anything else.
+'''
+RELEASE_DATE_FORMATS = ('%Y-%m-%d', '%Y.%m.%d', '%Y/%m/%d', '%d.%m.%Y',
+                        '%B %d, %Y', '%b %d, %Y')
+
+
+def parse_release_date(value):
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f'invalid date: {value!r}')
+    for date_format in RELEASE_DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(f'invalid date: {value!r}')
+
+
+'''
+listing(model, args, projection=None)
+  returns the list query of `model` narrowed by the filter arguments
+  in `args` (see LIST_FILTERS), its sort keys and whether it lists a
+  subset of the table. `sort` names a column of model.SORTS, prefixed
+  with `-` for descending order; the id follows in the same direction,
+  so the (column, id) B-tree indexes serve both directions and keyset
+  pagination; rows without a value in the sort column come last (see
+  pagination.order_clauses). Raises ValueError for invalid arguments.
+'''
+LIST_FILTERS = {
+    Movie: {
+        'release_from': (parse_release_date,
+                         lambda value: Movie.release_date >= value),
+        'release_to': (parse_release_date,
+                       lambda value: Movie.release_date <= value),
+    },
+    Actor: {
+        'gender': (str, lambda value:
+                   func.lower(Actor.gender) == value.lower()),
+        'age_min': (int, lambda value: Actor.age >= value),
+        'age_max': (int, lambda value: Actor.age <= value),
+    },
+}
+
+
+def listing(model, args, projection=None):
+    conditions = []
+    for name, (parse, condition) in LIST_FILTERS[model].items():
+        value = args.get(name, None)
+        if value is not None:
+            conditions.append(condition(parse(value)))
+
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    name = sort.lstrip('-')
+    if name not in model.SORTS:
+        raise ValueError(f'invalid sort: {sort!r}')
+    keys = [getattr(model, name)]
+    if name != 'id':
+        keys.append(model.id)
+    if descending:
+        keys = [key.desc() for key in keys]
+
+    query = model.list_query(projection)
+    if conditions:
+        query = query.filter(*conditions)
+    return query, keys, bool(conditions)
+
+
+search_backends = {}
+
+
+def search_backend(bind):
+    '''
+    Returns how the database of `bind` can search: 'trigram' on
+    PostgreSQL with the pg_trgm extension, 'fulltext' on PostgreSQL
+    without it (e.g. a database made by db.create_all() by a role that
+    may not create extensions) and 'like' elsewhere. Looked up once per
+    database.
+    '''
+    key = str(bind.engine.url)
+    backend = search_backends.get(key)
+    if backend is None:
+        backend = 'like'
+        if bind.dialect.name == 'postgresql':
+            installed = bind.execute(
+                "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+            ).scalar()
+            backend = 'trigram' if installed else 'fulltext'
+        search_backends[key] = backend
+    return backend
+
+
+def search_query(model, column, term, projection=None):
+    '''
+    Returns a query of the `model` rows whose `column` matches `term`
+    (loading the columns and relationship of `projection`),
+    and the sort keys ranking them by relevance. On PostgreSQL matches
+    are substring matches (trigram index) or full-text matches (GIN
+    index), both served by the indexes of the search migration and
+    ranked by ts_rank plus trigram similarity; without pg_trgm they are
+    full-text matches only, ranked by ts_rank. Other backends fall back
+    to a LIKE scan in id order.
+    '''
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+    contains = column.ilike(f'%{escaped}%', escape='\\')
+    query = model.list_query(projection)
+    backend = search_backend(db.session.get_bind())
+    if backend == 'like':
+        return query.filter(contains), [model.id]
+
+    document = func.to_tsvector('simple', func.coalesce(column, ''))
+    terms = func.plainto_tsquery('simple', term)
+    matches = document.op('@@')(terms)
+    rank = func.ts_rank(document, terms)
+    if backend == 'trigram':
+        matches = or_(contains, matches)
+        rank = rank + func.similarity(column, term)
+    # without pg_trgm the substring match couldn't use an index
+    return query.filter(matches), [rank.desc(), model.id]
+
+
+def iter_export(model, links=False, batch_size=1000):
+    '''
+    Yields every row of `model` as a dict of its columns, in id order,
+    without loading the table in memory: rows come from a server-side
+    cursor (stream_results) `batch_size` at a time. With `links` the
+    ids of the related rows from the `actors` association table are
+    added under `actor_ids` (movies) or `movie_ids` (actors), using an
+    outer join whose rows are regrouped per id as they stream.
+    '''
+    table = model.__table__
+    columns = [column.name for column in table.columns]
+    if model is Movie:
+        own, other, key = actors.c.movie_id, actors.c.actor_id, 'actor_ids'
+    else:
+        own, other, key = actors.c.actor_id, actors.c.movie_id, 'movie_ids'
+
+    if links:
+        statement = db.select([table, other.label('_link')]) \
+            .select_from(table.outerjoin(actors, own == table.c.id)) \
+            .order_by(table.c.id, other)
+    else:
+        statement = db.select([table]).order_by(table.c.id)
+
+    connection = db.session.connection()
+    result = connection.execution_options(stream_results=True) \
+        .execute(statement)
+    current = None
+    try:
+        while True:
+            batch = result.fetchmany(batch_size)
+            if not batch:
+                break
+            for row in batch:
+                if not links:
+                    yield {column: row[column] for column in columns}
+                    continue
+                if current is None or current['id'] != row['id']:
+                    if current is not None:
+                        yield current
+                    current = {column: row[column] for column in columns}
+                    current[key] = []
+                if row['_link'] is not None:
+                    current[key].append(row['_link'])
+        if current is not None:
+            yield current
+    finally:
+        result.close()
+
+
+# Bulk writes
+#   multi-row statements used by the bulk endpoints. They run in the
+#   current session transaction and leave the commit to the caller.
+def bulk_insert(model, rows):
+    '''
+    Inserts `rows` (dicts of column values) and returns their ids, in
+    order. PostgreSQL gets a single multi-row INSERT ... RETURNING;
+    other backends insert row by row in the same transaction.
+    '''
+    if not rows:
+        return []
+    table = model.__table__
+    bump_versions(table.name)
+    adjust_count(table.name, len(rows))
+    invalidate(table.name + 's')
+    if db.session.get_bind().dialect.name == 'postgresql':
+        result = db.session.execute(
+            table.insert().values(rows).returning(table.c.id))
+        return [row_id for (row_id,) in result]
+    return [db.session.execute(table.insert(), row).inserted_primary_key[0]
+            for row in rows]
+
+
+def bulk_update(model, rows):
+    '''
+    Updates rows by id. `rows` are dicts holding `id` and the columns
+    to change; rows changing the same columns share one executemany.
+    '''
+    table = model.__table__
+    groups = {}
+    for row in rows:
+        columns = tuple(sorted(key for key in row if key != 'id'))
+        groups.setdefault(columns, []).append(row)
+    if groups:
+        bump_versions(table.name)
+        invalidate(table.name + 's',
+                   *[f'{table.name}:{row["id"]}' for row in rows])
+    for columns, group in groups.items():
+        if not columns:
+            continue
+        statement = table.update() \
+            .where(table.c.id == db.bindparam('_id')) \
+            .values({column: db.bindparam(column) for column in columns})
+        db.session.execute(statement, [
+            dict({column: row[column] for column in columns},
+                 _id=row['id'])
+            for row in group
+        ])
+
+
+def bulk_delete(model, ids):
+    '''
+    Deletes the rows with the given ids and their `actors`
+    association rows with one DELETE each.
+    '''
+    if not ids:
+        return
+    link = actors.c.movie_id if model is Movie else actors.c.actor_id
+    db.session.execute(actors.delete().where(link.in_(ids)))
+    table = model.__table__
+    bump_versions(table.name, 'actors')
+    invalidate(table.name + 's', *[f'{table.name}:{row_id}' for row_id in ids])
+    result = db.session.execute(table.delete().where(table.c.id.in_(ids)))
+    adjust_count(table.name, -result.rowcount)
+
+
+def bulk_set_movie_actors(movie_actors, replace=False):
+    '''
+    Writes the casts of several movies with one executemany insert.
+    `movie_actors` maps movie ids to validated actor ids; with
+    `replace` the previous casts of those movies are removed first.
+    '''
+    if not movie_actors:
+        return
+    bump_versions('actors')
+    invalidate(*[f'movie:{movie_id}' for movie_id in movie_actors])
+    invalidate(*[f'actor:{actor_id}'
+                 for actor_ids in movie_actors.values()
+                 for actor_id in actor_ids])
+    if replace:
+        invalidate(*[f'actor:{actor_id}'
+                     for actor_id in linked_ids(list(movie_actors))])
+        db.session.execute(actors.delete().where(
+            actors.c.movie_id.in_(list(movie_actors))))
+    rows = [{'movie_id': movie_id, 'actor_id': actor_id}
+            for movie_id, actor_ids in movie_actors.items()
+            for actor_id in actor_ids]
+    if rows:
+        db.session.execute(actors.insert(), rows)
+
+
+def linked_ids(movie_ids):
+    '''
+    Returns the ids of the actors currently cast in the given movies.
+    '''
+    return {actor_id for (actor_id,) in
+            db.session.query(actors.c.actor_id)
+            .filter(actors.c.movie_id.in_(movie_ids))}
+
+
+def existing_ids(model, ids):
+    '''
+    Returns the subset of `ids` that exist, using a single IN query.
+    '''
+    if not ids:
+        return set()
+    return {row_id for (row_id,) in
+            db.session.query(model.id).filter(model.id.in_(ids))}
+
+
+class TableVersion(db.Model):
+    '''
+    Version counter and modification time of a table, bumped in the
+    same transaction as every write to it. Read endpoints derive their
+    ETag and Last-Modified headers from these rows.
+    '''
+    __tablename__ = 'table_version'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+
+
+VERSIONED_TABLES = ('movie', 'actor', 'actors')
+
+
+def seed_table_versions():
+    existing = {name for (name,) in db.session.query(TableVersion.name)}
+    for name in VERSIONED_TABLES:
+        if name not in existing:
+            db.session.add(TableVersion(name=name, version=0))
+    db.session.commit()
+
+
+def bump_versions(*names, connection=None):
+    '''
+    Increments the versions of the named tables as part of the current
+    transaction of the session (or of `connection`).
+    '''
+    execute = connection.execute if connection is not None \
+        else db.session.execute
+    table = TableVersion.__table__
+    execute(table.update()
+            .where(table.c.name.in_(names))
+            .values(version=table.c.version + 1,
+                    updated_at=datetime.utcnow()))
+
+
+def invalidate(*tags):
+    '''
+    Records response cache tags made stale by the current transaction.
+    They are invalidated once it commits (see response_cache) and
+    dropped if it rolls back.
+    '''
+    db.session.info.setdefault('cache_tags', set()).update(tags)
+
+
+class RowCount(db.Model):
+    '''
+    Number of rows of a table, adjusted in the same transaction as
+    every insert and delete so totals are read with a primary key
+    lookup instead of a COUNT(*) scan. `manage.py reconcile_counts`
+    repairs it if it ever drifts.
+    '''
+    __tablename__ = 'row_count'
+    name = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+COUNTED_TABLES = {'movie': Movie, 'actor': Actor}
+
+
+def seed_row_counts():
+    existing = {name for (name,) in db.session.query(RowCount.name)}
+    for name, model in COUNTED_TABLES.items():
+        if name not in existing:
+            db.session.add(RowCount(name=name, count=model.query.count()))
+    db.session.commit()
+
+
+def adjust_count(name, delta, connection=None):
+    '''
+    Adds `delta` to the row count of a table as part of the current
+    transaction of the session (or of `connection`). The increment is
+    relative, so concurrent writers never lose each other's updates.
+    '''
+    if not delta:
+        return
+    execute = connection.execute if connection is not None \
+        else db.session.execute
+    table = RowCount.__table__
+    execute(table.update()
+            .where(table.c.name == name)
+            .values(count=table.c.count + delta))
+
+
+def row_count(name):
+    '''
+    Returns the maintained row count of a table.
+    '''
+    count = db.session.query(RowCount.count) \
+        .filter(RowCount.name == name).scalar()
+    return count or 0
+
+
+def reconcile_counts():
+    '''
+    Recounts every counted table and fixes the rows that drifted.
+    The counter rows are locked first, so writes racing with the
+    recount are applied on top of the corrected value. Returns
+    {name: (stored, actual)} for the counts that were wrong.
+    '''
+    stored = {row.name: row for row in
+              db.session.query(RowCount).with_for_update()}
+    fixed = {}
+    for name, model in COUNTED_TABLES.items():
+        actual = db.session.query(func.count(model.id)).scalar()
+        row = stored.get(name)
+        if row is None:
+            db.session.add(RowCount(name=name, count=actual))
+            fixed[name] = (None, actual)
+        elif row.count != actual:
+            fixed[name] = (row.count, actual)
+            row.count = actual
+    db.session.commit()
+    return fixed
+
+
+def table_versions(names):
+    '''
+    Returns {name: (version, updated_at)} for the named tables with a
+    single primary key lookup.
+    '''
+    versions = {name: (0, None) for name in names}
+    for row in db.session.query(TableVersion) \
+            .filter(TableVersion.name.in_(names)):
+        versions[row.name] = (row.version, row.updated_at)
+    return versions
@@ -0,0 +1,124 @@
+import base64
+import binascii
+import json
+from datetime import date
+from sqlalchemy import and_, or_
+from sqlalchemy.sql.elements import UnaryExpression
+from sqlalchemy.sql import operators
+
+
+'''
+Helpers for keyset (cursor) pagination.
+
+A cursor is an opaque, url-safe token holding the sort key values of
+the last row of a page. The next page is selected with a WHERE clause
+on those values instead of an OFFSET, so the database seeks straight to
+it and every page costs the same as the first one. The sort keys must
+end with a unique column (the primary key) to give a total order.
+NULLs sort after every value (NULLS LAST ascending, NULLS FIRST
+descending, the PostgreSQL default), so rows without a value are kept
+and a descending order is the exact reverse of the ascending one.
+'''
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def order_columns(order_by):
+    '''
+    Normalizes a list of columns and `column.desc()` expressions into
+    (column, descending) pairs.
+    '''
+    order = []
+    for clause in order_by:
+        if isinstance(clause, UnaryExpression):
+            order.append((clause.element,
+                          clause.modifier is operators.desc_op))
+        else:
+            order.append((clause, False))
+    return order
+
+
+def order_clauses(order):
+    clauses = []
+    for column, descending in order:
+        if not column.nullable:
+            clauses.append(column.desc() if descending else column.asc())
+        elif descending:
+            clauses.append(column.desc().nullsfirst())
+        else:
+            clauses.append(column.asc().nullslast())
+    return clauses
+
+
+def encode_cursor(values):
+    data = json.dumps(values, separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(data.encode('utf-8')) \
+        .decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, order):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != len(order):
+        raise InvalidCursor(cursor)
+    try:
+        return [decode_value(column, value)
+                for (column, _), value in zip(order, values)]
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def decode_value(column, value):
+    '''
+    Checks a cursor value against the type of its sort column; dates
+    are encoded as ISO strings. Raises TypeError or ValueError.
+    '''
+    if value is None:
+        if not column.nullable:
+            raise ValueError(column.key)
+        return value
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if issubclass(python_type, date):
+        return date.fromisoformat(value)
+    if type(value) is not python_type:
+        raise TypeError(column.key)
+    return value
+
+
+def cursor_for(item, order):
+    return encode_cursor([getattr(item, column.key)
+                          for column, _ in order])
+
+
+def keyset_filter(order, values):
+    '''
+    Builds the condition selecting the rows that come after `values`
+    in `order`, i.e. the expansion of (a, b) > (x, y) that also works
+    for mixed ascending and descending keys and for NULLs.
+    '''
+    conditions = []
+    for i, (column, descending) in enumerate(order):
+        equal = [order[j][0].is_(None) if values[j] is None
+                 else order[j][0] == values[j] for j in range(i)]
+        if values[i] is None:
+            # NULLs come last: only non-NULL values follow them, and
+            # only in descending order
+            if not descending:
+                continue
+            after = column.isnot(None)
+        elif descending:
+            after = column < values[i]
+        elif column.nullable:
+            after = or_(column > values[i], column.is_(None))
+        else:
+            after = column > values[i]
+        conditions.append(and_(*equal, after))
+    return or_(*conditions)
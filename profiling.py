@@ -0,0 +1,163 @@
+import contextlib
+import logging
+import random
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+Per-request profiling.
+
+When PROFILING is on (or Server-Timing is), a sample of the requests
+(PROFILE_SAMPLE_RATE, 0 to 1) records the time spent verifying the
+access token (`auth`), running SQL (`db`, with the number of queries)
+and encoding the response (`serialize`), plus the total time of the
+handler; the rest of it is reported as `app` (routing, formatting
+rows, ...). Sampled requests slower than SLOW_REQUEST_MS and queries
+slower than SLOW_QUERY_MS are logged with their breakdown.
+
+SERVER_TIMING adds the timings to a `Server-Timing` header, which
+browsers show in their network panel. It defaults to on in debug and
+testing mode only, since it tells clients about the internals.
+
+With both off no hook is registered; `timed()` then only costs a
+lookup in `g`.
+'''
+
+logger = logging.getLogger(__name__)
+
+NOT_TIMED = contextlib.nullcontext()
+
+
+class Profile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.queries = 0
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def breakdown(self, total):
+        '''
+        Returns the timings with `app`, the time not spent in any of
+        them (e.g. formatting rows), and the `total`.
+        '''
+        timings = dict(self.timings)
+        timings['app'] = max(total - sum(self.timings.values()), 0.0)
+        timings['total'] = total
+        return timings
+
+    def server_timing(self, total):
+        parts = []
+        for name, seconds in self.breakdown(total).items():
+            part = f'{name};dur={seconds * 1000:.2f}'
+            if name == 'db':
+                part += f';desc="{self.queries} queries"'
+            parts.append(part)
+        return ', '.join(parts)
+
+
+class Timer:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profile.add(self.name, time.perf_counter() - self.started)
+
+
+def current_profile():
+    if has_request_context():
+        return g.get('profile')
+    return None
+
+
+def timed(name):
+    '''
+    Context manager adding the time of its block to `name` in the
+    profile of the current request, if it is profiled.
+    '''
+    profile = current_profile()
+    return profile.timer(name) if profile is not None else NOT_TIMED
+
+
+def init_profiling(app):
+    server_timing = app.config['SERVER_TIMING']
+    if server_timing is None:
+        server_timing = app.debug or app.testing
+    if not (app.config['PROFILING'] or server_timing):
+        return
+    listen_to_queries()
+    sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    slow_request = app.config['SLOW_REQUEST_MS'] / 1000
+
+    @app.before_request
+    def start_profile():
+        if sample_rate >= 1 or random.random() < sample_rate:
+            g.profile = Profile()
+            g.slow_query = app.config['SLOW_QUERY_MS'] / 1000
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.get('profile')
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.started
+        if server_timing:
+            response.headers['Server-Timing'] = profile.server_timing(total)
+        if total >= slow_request:
+            timings = profile.breakdown(total)
+            del timings['total']
+            logger.warning(
+                'Slow request %s %s: %.1f ms (%s, %d queries)',
+                request.method, request.full_path.rstrip('?'), total * 1000,
+                ', '.join(f'{name} {seconds * 1000:.1f} ms'
+                          for name, seconds in timings.items()),
+                profile.queries)
+        return response
+
+
+listening = False
+
+
+def listen_to_queries():
+    '''
+    Times every SQL statement run while a profiled request is active,
+    on every engine (primary and replicas).
+    '''
+    global listening
+    if listening:
+        return
+    listening = True
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_query(conn, cursor, statement, parameters, context,
+                     executemany):
+        if current_profile() is not None:
+            conn.info.setdefault('query_started', []) \
+                .append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_query(conn, cursor, statement, parameters, context,
+                    executemany):
+        profile = current_profile()
+        started = conn.info.get('query_started')
+        if profile is None or not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        profile.add('db', elapsed)
+        profile.queries += 1
+        if elapsed >= g.slow_query:
+            logger.warning('Slow query (%.1f ms) in %s %s: %s',
+                           elapsed * 1000, request.method, request.path,
+                           ' '.join(statement.split())[:500])
@@ -0,0 +1,320 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import request, current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+from models import keep_last_write, last_write_age
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+'''
+Response cache of the read endpoints.
+
+Entries are keyed by route, query arguments and the permissions of the
+caller, and tagged with the resources they embed: `movie:<id>` and
+`actor:<id>` for every movie and actor in the body, plus the `movies`
+or `actors` collection tag for list pages. Writes record the tags they
+make stale with models.invalidate() and the entries carrying them are
+dropped when the transaction commits. Because movies embed their actors
+and actors their movies, editing an actor also evicts the movies that
+list it.
+
+The in-process backend only sees the writes of its own process, so
+with several workers an entry may outlive a write made by another
+worker until its TTL expires. The Redis backend is shared by all
+workers and invalidated precisely, but may be refilled from a replica
+that has not caught up with a write yet. Either way a client that
+wrote recently (per its `last_write` cookie: within the TTL for the
+in-process backend, REPLICA_STICKY_SECONDS for Redis) is not served
+from the cache, so it always sees its own writes.
+'''
+
+
+class CacheBackend:
+    '''
+    Interface of the response cache backends.
+    '''
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, tags):
+        raise NotImplementedError
+
+    def invalidate(self, tags):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    def get(self, key):
+        return None
+
+    def set(self, key, value, tags):
+        pass
+
+    def invalidate(self, tags):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LocalCache(CacheBackend):
+    '''
+    In-process LRU bounded by `maxsize` entries and `ttl` seconds.
+    '''
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value, _ = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tags):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisCache(CacheBackend):
+    '''
+    Shared backend storing entries in Redis, with one set of keys per
+    tag so every worker sees the invalidations.
+    '''
+    def __init__(self, url, ttl=60, prefix='casting:cache:'):
+        if redis is None:
+            raise RuntimeError('The redis package is required for '
+                               'RESPONSE_CACHE=redis.')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, tags):
+        pipeline = self.client.pipeline()
+        pipeline.setex(self.prefix + key, self.ttl, json.dumps(value))
+        for tag in tags:
+            pipeline.sadd(self.prefix + 'tag:' + tag, key)
+            pipeline.expire(self.prefix + 'tag:' + tag, self.ttl)
+        pipeline.execute()
+
+    def invalidate(self, tags):
+        tag_keys = [self.prefix + 'tag:' + tag for tag in tags]
+        if not tag_keys:
+            return
+        keys = self.client.sunion(tag_keys)
+        pipeline = self.client.pipeline()
+        if keys:
+            pipeline.delete(*[self.prefix + key.decode('utf-8')
+                              for key in keys])
+        pipeline.delete(*tag_keys)
+        pipeline.execute()
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class ResponseCache:
+    '''
+    Holds the configured backend. `init_app` picks it from the
+    RESPONSE_CACHE setting: `local` (default), `redis` or `none`.
+    '''
+    def __init__(self):
+        self.backend = NullCache()
+        self.write_window = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        kind = app.config['RESPONSE_CACHE']
+        ttl = app.config['RESPONSE_CACHE_TTL']
+        if kind == 'local':
+            self.backend = LocalCache(app.config['RESPONSE_CACHE_SIZE'], ttl)
+            self.write_window = ttl
+        elif kind == 'redis':
+            self.backend = RedisCache(app.config['RESPONSE_CACHE_URL'], ttl)
+            self.write_window = app.config['REPLICA_STICKY_SECONDS']
+        else:
+            self.backend = NullCache()
+            self.write_window = 0
+        keep_last_write(self.write_window)
+
+    def wrote_recently(self):
+        '''
+        True when the client of the current request wrote less than
+        `write_window` seconds ago, so entries may predate its write.
+        '''
+        age = last_write_age()
+        return age is not None and age <= self.write_window
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def invalidate(self, tags):
+        if tags:
+            self.backend.invalidate(tags)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+response_cache = ResponseCache()
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def invalidate_after_commit(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        response_cache.invalidate(tags)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def discard_after_rollback(session):
+    session.info.pop('cache_tags', None)
+
+
+RESOURCES = {
+    'movie': ('movie', 'actors'),
+    'movies': ('movie', 'actors'),
+    'actor': ('actor', 'movies'),
+    'actors': ('actor', 'movies'),
+}
+
+
+def tags_for(data):
+    '''
+    Collects the `movie:<id>` and `actor:<id>` tags of every resource
+    embedded in a response body.
+    '''
+    tags = set()
+
+    def visit(kind, items):
+        if isinstance(items, dict):
+            items = [items]
+        if not isinstance(items, list):
+            return
+        tag, nested = RESOURCES[kind]
+        for item in items:
+            if isinstance(item, dict) and 'id' in item:
+                tags.add(f'{tag}:{item["id"]}')
+                visit(nested, item.get(nested))
+
+    for kind in RESOURCES:
+        if kind in data:
+            visit(kind, data[kind])
+    return tags
+
+
+def cache_key(payload):
+    scope = ' '.join(sorted(payload.get('permissions', [])))
+    args = urlencode(sorted(request.args.items(multi=True)))
+    raw = f'{request.method} {request.path}?{args}|{scope}'
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def cached(collection=None):
+    '''
+    Decorator serving a read endpoint from the response cache. Place it
+    between `requires_auth` and `conditional` so the cached response
+    keeps its ETag and conditional requests are answered from it too.
+    `collection` is the tag invalidated when rows are added or removed,
+    for list endpoints.
+    '''
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            key = cache_key(payload)
+            # the response is still stored: it is read after the write
+            entry = None if response_cache.wrote_recently() \
+                else response_cache.get(key)
+            if entry is not None:
+                response = current_app.response_class(
+                    entry['body'], status=200, headers=entry['headers'])
+                etag = response.get_etag()[0]
+                if etag and request.if_none_match.contains_weak(etag):
+                    return current_app.response_class(
+                        status=304, headers=entry['headers'])
+                return response
+
+            response = current_app.make_response(
+                f(payload, *args, **kwargs))
+            if response.status_code == 200 and response.is_json:
+                tags = tags_for(response.get_json())
+                if collection:
+                    tags.add(collection)
+                response_cache.backend.set(key, {
+                    'body': response.get_data(as_text=True),
+                    'headers': [(name, value) for name, value
+                                in response.headers
+                                if name in ('Content-Type', 'ETag',
+                                            'Last-Modified')]
+                }, tags)
+            return response
+        return wrapper
+    return cached_decorator
@@ -0,0 +1,116 @@
+import json
+from datetime import date
+
+from flask import current_app
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+from profiling import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+'''
+JSON serializer backends of the API responses.
+
+`jsonify` is a drop-in replacement for flask.jsonify that encodes with
+the backend of the current app: orjson when it is installed (`auto`),
+or the standard library encoder. Both follow Flask's settings: keys
+are sorted with JSON_SORT_KEYS, dates are written in ISO 8601, other
+values Flask knows about (UUIDs, ...) are encoded by Flask's
+JSONEncoder, and the output is compact unless
+the app runs in debug mode or JSONIFY_PRETTYPRINT_REGULAR is set. The
+only difference is that orjson writes non-ASCII characters as UTF-8
+instead of \\u escapes, which decodes to the same document.
+'''
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    '''
+    Flask's encoder, with dates in ISO 8601 (`2020-08-09`) instead of
+    HTTP dates, like orjson writes them.
+    '''
+    def default(self, o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return super().default(o)
+
+
+class StdlibSerializer:
+    name = 'stdlib'
+
+    def __init__(self, sort_keys=True, ensure_ascii=True):
+        self.sort_keys = sort_keys
+        self.ensure_ascii = ensure_ascii
+
+    def dumps(self, data, pretty=False):
+        return json.dumps(data, cls=JSONEncoder, sort_keys=self.sort_keys,
+                          ensure_ascii=self.ensure_ascii,
+                          indent=2 if pretty else None,
+                          separators=(', ', ': ') if pretty
+                          else (',', ':')).encode('utf-8')
+
+
+class OrjsonSerializer:
+    name = 'orjson'
+
+    def __init__(self, sort_keys=True):
+        if orjson is None:
+            raise RuntimeError('The orjson package is required for '
+                               'JSON_BACKEND=orjson.')
+        self.options = orjson.OPT_SORT_KEYS if sort_keys else 0
+        # values orjson can't encode go through the encoder of the
+        # stdlib backend, so they keep the same representation
+        self.default = JSONEncoder().default
+
+    def dumps(self, data, pretty=False):
+        options = self.options | orjson.OPT_INDENT_2 if pretty \
+            else self.options
+        return orjson.dumps(data, default=self.default, option=options)
+
+
+def make_serializer(name, config):
+    '''
+    Builds the serializer named by JSON_BACKEND: `auto` (orjson when
+    installed, else stdlib), `orjson` or `stdlib`.
+    '''
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name == 'orjson':
+        return OrjsonSerializer(sort_keys=config['JSON_SORT_KEYS'])
+    if name == 'stdlib':
+        return StdlibSerializer(sort_keys=config['JSON_SORT_KEYS'],
+                                ensure_ascii=config['JSON_AS_ASCII'])
+    raise ValueError(f'Unknown JSON backend: {name}')
+
+
+def init_serializer(app, serializer=None):
+    '''
+    Registers `serializer` (or the one configured by JSON_BACKEND)
+    as the JSON serializer of the app.
+    '''
+    if serializer is None:
+        serializer = make_serializer(app.config['JSON_BACKEND'], app.config)
+    app.extensions['serializer'] = serializer
+
+
+def dumps(data):
+    '''
+    Encodes `data` with the serializer of the current app, as bytes.
+    '''
+    app = current_app
+    serializer = app.extensions['serializer']
+    pretty = app.config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug
+    with timed('serialize'):
+        return serializer.dumps(data, pretty=pretty)
+
+
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both '
+                        'args and kwargs')
+    data = args[0] if len(args) == 1 else args or kwargs
+    return current_app.response_class(
+        dumps(data) + b'\n', mimetype=current_app.config['JSONIFY_MIMETYPE'])
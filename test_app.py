@@ -1,13 +1,42 @@
+import asyncio
+import gzip
 import os
+import shutil
 import unittest
 import json
+import tempfile
+import time
+from datetime import date
+from unittest import mock
+import httpx
+from flask import Flask, Response, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, exc, inspect
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
 
 from app import create_app
-from models import setup_db, Actor, Movie
+from asgi import ASGIApplication
+from bench import PERMISSIONS, LocalIssuer, percentile, regressions
+from auth import JWKSStore, TokenCache
+from bulk import (MOVIE_FIELDS, validate_create, validate_update,
+                  validate_delete, check_actor_references)
+from http_cache import not_modified
+from importer import read_rows, entity_values, to_ids
+from pagination import (InvalidCursor, order_columns, order_clauses,
+                        encode_cursor, decode_cursor, keyset_filter,
+                        cursor_for)
+from compression import brotli
+from metrics import Metrics, mark_process_dead, metrics, render
+from models import (Actor, Movie, MeteredQueuePool, pool_metrics,
+                    engine_options, ReplicaSet, db, listing,
+                    parse_release_date, search_backend, search_backends,
+                    search_query)
+from response_cache import LocalCache, tags_for
+from serializer import StdlibSerializer, OrjsonSerializer, orjson, dumps
 
 
-def sample_movie(title='Hannibal', release_date='2020.08.09'):
+def sample_movie(title='Hannibal', release_date=date(2020, 8, 9)):
     return Movie(title=title, release_date=release_date)
 
 
@@ -15,17 +44,50 @@ def sample_actor(name='Jane Kandy', age=32, gender='Male'):
     return Actor(name=name, age=age, gender=gender)
 
 
+class SQLiteTestCase(unittest.TestCase):
+    """This class represents the base of the test cases run against a
+    temporary SQLite database, with tokens signed by a local key"""
+
+    keys = None
+    config = {}
+
+    @classmethod
+    def setUpClass(cls):
+        # one key for the whole run, generating it takes a while
+        if SQLiteTestCase.keys is None:
+            SQLiteTestCase.keys = tempfile.TemporaryDirectory()
+            SQLiteTestCase.issuer = LocalIssuer(SQLiteTestCase.keys.name)
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.database_url = 'sqlite:///' + self.path
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def create_app(self, **config):
+        return create_app(dict({
+            'DATABASE_URL': self.database_url,
+            'JWKS_URL': self.issuer.jwks_path,
+            'JWKS_PREWARM': False
+        }, **self.config, **config))
+
+    def auth(self, *permissions):
+        token = self.issuer.token(list(permissions or PERMISSIONS))
+        return {'Authorization': 'Bearer ' + token}
+
+
 class MovieTestCase(unittest.TestCase):
     """This class represents the poject test case"""
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
         self.database_name = "postgres"
         self.database_path = "postgresql://{}/{}".format('localhost:5432',
                                                          self.database_name)
-        setup_db(self.app, self.database_path)
+        self.app = create_app({'DATABASE_URL': self.database_path})
+        self.client = self.app.test_client
 
         self.new_movie = {
             "title": "King Kong",
@@ -111,7 +173,8 @@ class MovieTestCase(unittest.TestCase):
 
     def test_delete_movie(self):
         res = self.client().delete(('/movies/22'),
-                headers=dict(Authorization='Bearer ' + self.token3))
+                headers=dict(Authorization='Bearer ' + self.token3,
+                             Prefer='return=representation'))
         data = json.loads(res.data)
 
         movie = Movie.query.filter(Movie.id == 22).one_or_none()
@@ -134,7 +197,8 @@ class MovieTestCase(unittest.TestCase):
 
     def test_create_movie(self):
         res = self.client().post('/movies', json=self.new_movie,
-                        headers=dict(Authorization='Bearer ' + self.token3))
+                        headers=dict(Authorization='Bearer ' + self.token3,
+                                     Prefer='return=representation'))
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -208,7 +272,8 @@ class MovieTestCase(unittest.TestCase):
 
     def test_delete_actor(self):
         res = self.client().delete('/actors/13',
-                        headers=dict(Authorization='Bearer ' + self.token2))
+                        headers=dict(Authorization='Bearer ' + self.token2,
+                                     Prefer='return=representation'))
         data = json.loads(res.data)
 
         actor = Actor.query.filter(Actor.id == 13).one_or_none()
@@ -231,7 +296,8 @@ class MovieTestCase(unittest.TestCase):
 
     def test_create_actor(self):
         res = self.client().post('/actors', json=self.new_actor,
-                        headers=dict(Authorization='Bearer ' + self.token2))
+                        headers=dict(Authorization='Bearer ' + self.token2,
+                                     Prefer='return=representation'))
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -259,5 +325,1423 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(data['description'], 'Permission not found.')
 
 
+class APITestCase(SQLiteTestCase):
+    """This class represents the endpoint test case, run offline"""
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.client = self.app.test_client()
+        self.viewer = self.auth('view:actors', 'view:movies')
+        self.producer = self.auth()
+        with self.app.app_context():
+            cast = [sample_actor(), sample_actor(name='actor2')]
+            for actor in cast:
+                actor.insert()
+            movie = sample_movie()
+            movie.actors = cast
+            movie.insert()
+            sample_movie('movie2', date(1997, 12, 19)).insert()
+
+    def statements(self, method, url, **kwargs):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            res = self.client.open(url, method=method, **kwargs)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+        return res, statements
+
+    def test_get_movies_per_page(self):
+        res = self.client.get('/movies?per_page=1', headers=self.viewer)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [1])
+        self.assertEqual(data['total_movies'], 2)
+
+        res = self.client.get('/movies?per_page=1&page=2',
+                              headers=self.viewer)
+
+        self.assertEqual([movie['id'] for movie in res.get_json()['movies']],
+                         [2])
+
+    def test_per_page_is_capped(self):
+        self.app.config['MAX_PER_PAGE'] = 1
+
+        res = self.client.get('/movies?per_page=100000', headers=self.viewer)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.get_json()['movies']), 1)
+
+    def test_404_beyond_the_last_page(self):
+        res = self.client.get('/actors?page=2', headers=self.viewer)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res.get_json()['message'], 'page not found')
+
+    def test_get_movies_with_cursor(self):
+        ids, cursor = [], ''
+        while cursor is not None:
+            res = self.client.get('/movies?per_page=1&cursor=' + cursor,
+                                  headers=self.viewer)
+            data = res.get_json()
+            self.assertEqual(res.status_code, 200)
+            ids += [movie['id'] for movie in data['movies']]
+            cursor = data['next_cursor']
+
+        self.assertEqual(ids, [1, 2])
+
+    def test_400_for_invalid_cursor(self):
+        res = self.client.get('/movies?cursor=invalid', headers=self.viewer)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json()['message'], 'invalid cursor')
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        for url in ('/movies', '/actors'):
+            counts = []
+            for per_page in (1, 10):
+                res, statements = self.statements(
+                    'GET', '%s?per_page=%d' % (url, per_page),
+                    headers=self.viewer)
+                self.assertEqual(res.status_code, 200)
+                counts.append(len(statements))
+
+            self.assertEqual(counts[0], counts[1])
+
+    def test_create_movie_with_actors(self):
+        res = self.client.post('/movies', json={
+            'title': 'King Kong', 'release_date': '2020-02-01',
+            'actors': [2, 1, 2]
+        }, headers=self.producer)
+        created = res.get_json()['created']
+
+        res = self.client.get('/movies/%d' % created, headers=self.viewer)
+
+        self.assertEqual(sorted(actor['id'] for actor
+                                in res.get_json()['movie']['actors']), [1, 2])
+
+    def test_400_lists_unknown_actors(self):
+        res = self.client.post('/movies', json={
+            'title': 'King Kong', 'release_date': '2020-02-01',
+            'actors': [1, 100000, 100001]
+        }, headers=self.producer)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'bad request')
+        self.assertEqual(data['missing_actors'], [100000, 100001])
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 2)
+
+    def test_create_movie_returns_minimal_body_by_default(self):
+        res, statements = self.statements('POST', '/movies', json={
+            'title': 'King Kong', 'release_date': '2020-02-01'
+        }, headers=self.producer)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['title'], 'King Kong')
+        self.assertEqual(data['total_movies'], 3)
+        self.assertNotIn('movies', data)
+        self.assertEqual(res.headers['Preference-Applied'], 'return=minimal')
+        self.assertFalse([statement for statement in statements
+                          if 'LIMIT' in statement])
+
+    def test_representation_is_returned_when_preferred(self):
+        res = self.client.patch('/actors/1', json={'age': 40},
+                                headers=dict(self.producer,
+                                             Prefer='return=representation'))
+        data = res.get_json()
+
+        self.assertEqual(res.headers['Preference-Applied'],
+                         'return=representation')
+        self.assertEqual([actor['id'] for actor in data['actors']], [1, 2])
+        self.assertEqual(data['total_actors'], 2)
+
+        res = self.client.delete('/movies/2?return=representation',
+                                 headers=self.producer)
+        data = res.get_json()
+
+        self.assertEqual(data['deleted'], 2)
+        self.assertEqual([movie['id'] for movie in data['movies']], [1])
+
+    def test_bulk_create_movies(self):
+        movie = {'title': 'King Kong', 'release_date': '2020-02-01'}
+        res = self.client.post('/movies/bulk',
+                               json=[movie, dict(movie, actors=[1])],
+                               headers=self.producer)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([result['status'] for result in data['results']],
+                         ['created', 'created'])
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 4)
+
+    def test_bulk_create_movies_is_rejected_as_a_whole(self):
+        res = self.client.post('/movies/bulk', json=[
+            {'title': 'King Kong', 'release_date': '2020-02-01'},
+            {'title': 'no date'}
+        ], headers=self.producer)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([result['status'] for result in data['results']],
+                         ['skipped', 'invalid'])
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 2)
+
+    def test_bulk_create_movies_with_unknown_actors(self):
+        movie = {'title': 'King Kong', 'release_date': '2020-02-01'}
+        res = self.client.post('/movies/bulk',
+                               json=[movie, dict(movie, actors=[1, 99])],
+                               headers=self.producer)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([result['status'] for result in data['results']],
+                         ['skipped', 'invalid'])
+        self.assertEqual(data['results'][1]['missing_actors'], [99])
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 2)
+
+    def test_bulk_delete_actors(self):
+        res = self.client.delete('/actors/bulk', json=[1, {'id': 2}],
+                                 headers=self.producer)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['status'] for result
+                          in res.get_json()['results']],
+                         ['deleted', 'deleted'])
+        res = self.client.get('/movies/1', headers=self.viewer)
+        self.assertEqual(res.get_json()['movie']['actors'], [])
+
+    def test_search_movies(self):
+        res = self.client.get('/search?type=movies&q=hannibal',
+                              headers=self.viewer)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_movies'], 1)
+        self.assertEqual(data['movies'][0]['title'], 'Hannibal')
+
+    def test_search_actors_needs_their_permission(self):
+        res = self.client.get('/search?type=actors&q=actor2',
+                              headers=self.viewer)
+        self.assertEqual([actor['id'] for actor
+                          in res.get_json()['actors']], [2])
+
+        res = self.client.get('/search?type=actors&q=actor2',
+                              headers=self.auth('view:movies'))
+        self.assertEqual(res.status_code, 403)
+
+    def test_400_for_search_without_term(self):
+        res = self.client.get('/search?type=movies', headers=self.viewer)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json()['message'], 'bad request')
+
+    def test_export_movies_as_ndjson(self):
+        # rows of one movie span several batches
+        self.app.config['EXPORT_BATCH_SIZE'] = 1
+
+        res = self.client.get('/export/movies?links=1', headers=self.viewer)
+        rows = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(rows, [
+            {'id': 1, 'title': 'Hannibal', 'release_date': '2020-08-09',
+             'actor_ids': [1, 2]},
+            {'id': 2, 'title': 'movie2', 'release_date': '1997-12-19',
+             'actor_ids': []}
+        ])
+
+    def test_export_actors_as_csv(self):
+        res = self.client.get('/export/actors?format=csv&links=1',
+                              headers=self.viewer)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data.decode().splitlines(), [
+            'id,name,age,gender,movie_ids',
+            '1,Jane Kandy,32,Male,1',
+            '2,actor2,32,Male,1'
+        ])
+
+    def test_304_for_unchanged_movies(self):
+        etag = self.client.get('/movies', headers=self.viewer) \
+            .headers['ETag']
+
+        res = self.client.get('/movies',
+                              headers=dict(self.viewer, **{
+                                  'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.data, b'')
+
+    def test_304_for_unchanged_export(self):
+        res = self.client.get('/export/movies', headers=self.viewer)
+
+        res = self.client.get('/export/movies',
+                              headers=dict(self.viewer, **{
+                                  'If-None-Match': res.headers['ETag']}))
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_304_if_not_modified_since(self):
+        res = self.client.get('/search?q=movie', headers=self.viewer)
+        last_modified = res.headers['Last-Modified']
+
+        res = self.client.get('/search?q=movie',
+                              headers=dict(self.viewer, **{
+                                  'If-Modified-Since': last_modified}))
+
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client.get('/search?q=movie',
+                              headers=dict(self.viewer, **{
+                                  'If-Modified-Since':
+                                  'Sat, 01 Jan 2000 00:00:00 GMT'}))
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_etag_changes_after_write(self):
+        etag = self.client.get('/movies/1', headers=self.viewer) \
+            .headers['ETag']
+        self.client.patch('/movies/1', json={'title': 'Changed'},
+                          headers=self.producer)
+
+        res = self.client.get('/movies/1',
+                              headers=dict(self.viewer, **{
+                                  'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.get_json()['movie']['title'], 'Changed')
+
+    def test_unauthorized_client_gets_no_304(self):
+        etag = self.client.get('/movies', headers=self.viewer) \
+            .headers['ETag']
+
+        res = self.client.get('/movies', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 401)
+
+    def test_second_read_is_served_from_cache(self):
+        first, _ = self.statements('GET', '/movies/1', headers=self.viewer)
+        second, statements = self.statements('GET', '/movies/1',
+                                             headers=self.viewer)
+
+        self.assertEqual(statements, [])
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+
+    def test_cached_movie_is_refreshed_after_actor_update(self):
+        # reads by another client, which has no last_write cookie
+        reader = self.app.test_client(use_cookies=False)
+        actor_id = reader.get('/movies/1', headers=self.viewer) \
+            .get_json()['movie']['actors'][0]['id']
+        self.client.patch('/actors/%d' % actor_id,
+                          json={'name': 'Renamed'}, headers=self.producer)
+
+        res = reader.get('/movies/1', headers=self.viewer)
+        names = [actor['name'] for actor in res.get_json()['movie']['actors']]
+
+        self.assertIn('Renamed', names)
+
+    def test_cached_actor_is_refreshed_after_movie_update(self):
+        reader = self.app.test_client(use_cookies=False)
+        reader.get('/actors/1', headers=self.viewer)
+        self.client.patch('/movies/1', json={'title': 'Renamed'},
+                          headers=self.producer)
+
+        res = reader.get('/actors/1', headers=self.viewer)
+        movies = res.get_json()['actor']['movies']
+
+        self.assertEqual([movie['title'] for movie in movies], ['Renamed'])
+
+    def test_cached_list_is_refreshed_after_create_and_delete(self):
+        reader = self.app.test_client(use_cookies=False)
+        reader.get('/movies', headers=self.viewer)
+        created = self.client.post('/movies', json={
+            'title': 'King Kong', 'release_date': '2020-02-01'
+        }, headers=self.producer).get_json()['created']
+
+        res = reader.get('/movies', headers=self.viewer)
+        self.assertIn(created, [movie['id'] for movie
+                                in res.get_json()['movies']])
+
+        self.client.delete('/movies/%d' % created, headers=self.producer)
+
+        res = reader.get('/movies', headers=self.viewer)
+        self.assertNotIn(created, [movie['id'] for movie
+                                   in res.get_json()['movies']])
+
+    def test_differently_encoded_queries_are_cached_apart(self):
+        self.client.get('/movies?page=1%26per_page%3D1', headers=self.viewer)
+
+        res = self.client.get('/movies?page=1&per_page=1',
+                              headers=self.viewer)
+
+        self.assertEqual(len(res.get_json()['movies']), 1)
+
+    def test_total_movies_follows_creates_and_deletes(self):
+        created = self.client.post('/movies', json={
+            'title': 'King Kong', 'release_date': '2020-02-01'
+        }, headers=self.producer).get_json()
+        self.assertEqual(created['total_movies'], 3)
+
+        deleted = self.client.delete('/movies/%d' % created['created'],
+                                     headers=self.producer).get_json()
+        self.assertEqual(deleted['total_movies'], 2)
+
+        res, statements = self.statements('GET', '/movies',
+                                          headers=self.viewer)
+        self.assertEqual(res.get_json()['total_movies'], 2)
+        self.assertFalse([statement for statement in statements
+                          if 'count(' in statement.lower()])
+
+    def test_single_actor_returns_total_actors(self):
+        res = self.client.get('/actors/1', headers=self.viewer)
+
+        self.assertEqual(res.get_json()['total_actors'], 2)
+
+    def test_client_that_wrote_is_not_served_from_cache(self):
+        self.client.get('/movies/2', headers=self.viewer)
+        # a write made by another worker, whose cache is not this one
+        engine = create_engine(self.database_url)
+        engine.execute("UPDATE movie SET title = 'Changed' WHERE id = 2")
+        engine.dispose()
+
+        res = self.client.get('/movies/2', headers=self.viewer)
+        self.assertEqual(res.get_json()['movie']['title'], 'movie2')
+
+        self.client.set_cookie('localhost', 'last_write', str(time.time()))
+        res = self.client.get('/movies/2', headers=self.viewer)
+        self.assertEqual(res.get_json()['movie']['title'], 'Changed')
+
+    def test_writes_set_the_last_write_cookie(self):
+        res = self.client.patch('/movies/2', json={'title': 'Changed'},
+                                headers=self.producer)
+
+        cookie = res.headers['Set-Cookie']
+        self.assertIn('last_write=', cookie)
+        self.assertIn('Max-Age=%d' % self.app.config['RESPONSE_CACHE_TTL'],
+                      cookie)
+
+    def test_movies_with_sparse_fieldset(self):
+        res, statements = self.statements(
+            'GET', '/movies?fields=title&include=none', headers=self.viewer)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['movies'], [
+            {'id': 1, 'title': 'Hannibal'}, {'id': 2, 'title': 'movie2'}])
+        self.assertFalse([statement for statement in statements
+                          if 'actors' in statement])
+
+    def test_actor_with_included_movie_fields(self):
+        res = self.client.get('/actors/1?fields=name', headers=self.viewer)
+
+        self.assertEqual(res.get_json()['actor'], {
+            'id': 1, 'name': 'Jane Kandy',
+            'movies': [{'id': 1, 'title': 'Hannibal',
+                        'release_date': '2020-08-09'}]})
+
+    def test_400_for_unknown_field(self):
+        for url in ('/actors/1?fields=salary', '/movies?include=studios'):
+            res = self.client.get(url, headers=self.viewer)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(res.get_json()['success'], False)
+
+    def test_cursor_follows_the_sort_order(self):
+        res = self.client.get('/actors?per_page=1&cursor=&sort=-age',
+                              headers=self.viewer)
+        data = res.get_json()
+        self.assertEqual([actor['id'] for actor in data['actors']], [2])
+
+        res = self.client.get('/actors?per_page=1&sort=-age&cursor=' +
+                              data['next_cursor'], headers=self.viewer)
+        data = res.get_json()
+
+        # equal ages: ties are broken by id in the same direction
+        self.assertEqual([actor['id'] for actor in data['actors']], [1])
+        self.assertEqual(data['next_cursor'], None)
+
+    def test_400_for_cursor_of_another_sort(self):
+        res = self.client.get('/actors?per_page=1&cursor=&sort=name',
+                              headers=self.viewer)
+        cursor = res.get_json()['next_cursor']
+
+        res = self.client.get('/actors?sort=age&cursor=' + cursor,
+                              headers=self.viewer)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json()['message'], 'invalid cursor')
+
+    def test_movies_filtered_by_release_date(self):
+        res = self.client.get('/movies?release_from=2000.01.01'
+                              '&sort=-release_date', headers=self.viewer)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [1])
+        self.assertEqual(data['total_movies'], 1)
+
+    def test_actors_filtered_by_gender_and_age(self):
+        self.client.patch('/actors/2', json={'gender': 'female', 'age': 50},
+                          headers=self.producer)
+
+        res = self.client.get('/actors?gender=Female&age_min=40',
+                              headers=self.viewer)
+
+        self.assertEqual([actor['id'] for actor
+                          in res.get_json()['actors']], [2])
+
+    def test_release_date_is_parsed_and_returned_as_iso(self):
+        res = self.client.post('/movies', json={
+            'title': 'King Kong', 'release_date': 'February 1, 2020'
+        }, headers=self.producer)
+        self.assertEqual(res.get_json()['movie']['release_date'],
+                         '2020-02-01')
+
+        res = self.client.patch('/movies/1', json={'release_date': 'soon'},
+                                headers=self.producer)
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_for_invalid_sort(self):
+        for url in ('/actors?sort=salary', '/actors?age_min=old',
+                    '/movies?release_to=soon'):
+            res = self.client.get(url, headers=self.viewer)
+
+            self.assertEqual(res.status_code, 400)
+
+
+class CursorTestCase(unittest.TestCase):
+    """This class represents the keyset pagination cursor test case"""
+
+    def setUp(self):
+        self.order = order_columns([Movie.release_date.desc(), Movie.id])
+
+    def test_cursor_round_trip(self):
+        cursor = encode_cursor([date(2020, 8, 9), 4])
+
+        self.assertEqual(decode_cursor(cursor, self.order),
+                         [date(2020, 8, 9), 4])
+
+    def test_descending_columns_are_detected(self):
+        self.assertEqual([descending for _, descending in self.order],
+                         [True, False])
+
+    def test_malformed_cursor_is_rejected(self):
+        with self.assertRaises(InvalidCursor):
+            decode_cursor('not a cursor', self.order)
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(encode_cursor([4]), self.order)
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(encode_cursor(['2020.08.09', 4]), self.order)
+
+    def test_values_must_match_the_column_types(self):
+        for values in ([date(2020, 8, 9), '4'], [date(2020, 8, 9), True],
+                       [2020, 4], [None, None]):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(encode_cursor(values), self.order)
+
+    def test_null_values_of_nullable_columns_are_accepted(self):
+        self.assertEqual(decode_cursor(encode_cursor([None, 4]), self.order),
+                         [None, 4])
+
+
+class BulkValidationTestCase(unittest.TestCase):
+    """This class represents the bulk payload validation test case"""
+
+    def test_create_items_are_validated(self):
+        results, rows = validate_create(
+            [{'title': 'a', 'release_date': 'b', 'actors': [1, 1, 2]},
+             {'title': 'a'}, 'movie'],
+            MOVIE_FIELDS, ('actors',))
+
+        self.assertEqual([result['status'] for result in results],
+                         [None, 'invalid', 'invalid'])
+        self.assertEqual(rows[0]['relations']['actors'], [1, 2])
+
+    def test_update_items_need_an_id_and_a_change(self):
+        results, rows = validate_update(
+            [{'id': 1, 'title': 'a'}, {'id': 2}, {'title': 'a'},
+             {'id': 1, 'title': 'b'}],
+            MOVIE_FIELDS, ('actors',))
+
+        self.assertEqual([result['status'] for result in results],
+                         [None, 'invalid', 'invalid', 'invalid'])
+        self.assertEqual(rows, [{'index': 0, 'id': 1,
+                                 'values': {'title': 'a'},
+                                 'relations': {}}])
+
+    def test_delete_items_accept_ids_and_objects(self):
+        results, rows = validate_delete([1, {'id': 2}, 'x'])
+
+        self.assertEqual([row['id'] for row in rows], [1, 2])
+        self.assertEqual(results[2]['status'], 'invalid')
+
+    def test_actor_references_are_resolved_at_once(self):
+        calls = []
+
+        def missing_ids(ids):
+            calls.append(ids)
+            return [3]
+
+        results, rows = validate_create(
+            [{'title': 'a', 'release_date': 'b', 'actors': [1, 3]},
+             {'title': 'a', 'release_date': 'b', 'actors': [1, 2]}],
+            MOVIE_FIELDS, ('actors',))
+        rows = check_actor_references(results, rows, missing_ids)
+
+        self.assertEqual(calls, [[1, 3, 2]])
+        self.assertEqual(results[0]['missing_actors'], [3])
+        self.assertEqual([row['index'] for row in rows], [1])
+
+
+class ImporterTestCase(unittest.TestCase):
+    """This class represents the bulk import file parsing test case"""
+
+    def write(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_read_csv_rows(self):
+        path = self.write('.csv', 'id,name,age,gender\n1,Jane,,female\n')
+
+        self.assertEqual(list(read_rows(path)), [
+            {'id': '1', 'name': 'Jane', 'age': None, 'gender': 'female'}])
+
+    def test_read_ndjson_rows(self):
+        path = self.write('.ndjson', '{"id": 1, "title": "a"}\n\n')
+
+        self.assertEqual(list(read_rows(path)), [{'id': 1, 'title': 'a'}])
+
+    def test_rows_without_id_or_key_are_skipped(self):
+        self.assertEqual(entity_values('actor', {'name': 'Jane'}), None)
+        self.assertEqual(entity_values('movie', {'id': '1', 'title': 'a'}),
+                         None)
+        self.assertEqual(entity_values('actor', {'id': '2', 'name': 'Jane',
+                                                 'age': '30'}),
+                         {'source_id': 2, 'name': 'Jane', 'age': 30,
+                          'gender': None})
+
+    def test_release_dates_are_parsed(self):
+        self.assertEqual(entity_values('movie', {
+            'id': '1', 'title': 'a', 'release_date': '2020.08.09'
+        })['release_date'], date(2020, 8, 9))
+        self.assertEqual(entity_values('movie', {
+            'id': '1', 'title': 'a', 'release_date': 'soon'
+        }), None)
+
+    def test_actor_ids_from_csv_and_ndjson(self):
+        self.assertEqual(to_ids('1 2'), [1, 2])
+        self.assertEqual(to_ids([3]), [3])
+        self.assertEqual(to_ids(None), [])
+
+
+def sample_jwk(kid='key-1'):
+    return {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'abc', 'e': 'AQAB'}
+
+
+class FakeAsyncClient:
+    def __init__(self, jwks):
+        self.jwks = jwks
+        self.requested = []
+
+    async def get(self, url, timeout=None):
+        self.requested.append(url)
+        return self
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.jwks
+
+
+class JWKSStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.write_keys(sample_jwk())
+        self.store = JWKSStore(self.path, ttl=600, min_refresh_interval=600)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write_keys(self, *keys):
+        with open(self.path, 'w') as f:
+            json.dump({'keys': list(keys)}, f)
+
+    def test_get_key_by_kid(self):
+        self.assertEqual(self.store.get('key-1')['kid'], 'key-1')
+        self.assertEqual(self.store.get('key-1')['n'], 'abc')
+
+    def test_async_refresh_fetches_with_the_client(self):
+        store = JWKSStore('https://example.com/.well-known/jwks.json')
+        client = FakeAsyncClient({'keys': [sample_jwk('key-2')]})
+
+        self.assertTrue(asyncio.run(store.refresh_async(client)))
+        self.assertEqual(client.requested, [store.source])
+        self.assertEqual(store.peek('key-2')['kid'], 'key-2')
+
+    def test_keys_served_from_memory(self):
+        self.store.get('key-1')
+        self.write_keys()
+
+        self.assertTrue(self.store.get('key-1'))
+
+    def test_unknown_kid_forces_refresh(self):
+        store = JWKSStore(self.path, ttl=600, min_refresh_interval=0)
+        store.prewarm()
+        self.write_keys(sample_jwk(), sample_jwk('key-2'))
+
+        self.assertTrue(store.get('key-2'))
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        self.store.prewarm()
+        self.write_keys(sample_jwk(), sample_jwk('key-2'))
+
+        self.assertEqual(self.store.get('key-2'), None)
+
+    def test_stale_reads_during_an_outage_fetch_once(self):
+        store = JWKSStore(self.path, ttl=0, min_refresh_interval=30)
+        store.prewarm()
+        os.remove(self.path)
+        # the keys went stale and the last fetch was a minute ago
+        store._fetched_at -= 60
+        store._last_attempt -= 60
+        attempts = []
+        refresh = store.refresh
+        store.refresh = lambda: attempts.append(1) or refresh()
+
+        with self.assertLogs('auth', 'ERROR'):
+            for _ in range(200):
+                self.assertTrue(store.get('key-1'))
+                # each read comes after the last fetch failed
+                while store._refreshing:
+                    time.sleep(0.001)
+
+        self.assertEqual(len(attempts), 1)
+        self.write_keys()
+
+    def test_stale_keys_kept_when_source_fails(self):
+        self.store.prewarm()
+        os.remove(self.path)
+
+        self.assertFalse(self.store.refresh())
+        self.assertTrue(self.store.get('key-1'))
+        self.write_keys()
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        with open(self.path, 'w') as f:
+            json.dump({'keys': [sample_jwk()]}, f)
+        self.store = JWKSStore(self.path)
+        self.store.prewarm()
+        self.cache = TokenCache(maxsize=2, store=self.store)
+        self.payload = {
+            'exp': int(time.time()) + 3600,
+            'permissions': ['view:movies']
+        }
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_cached_token_is_returned(self):
+        self.cache.put('token', self.payload, self.store.get('key-1'))
+        entry = self.cache.get('token')
+
+        self.assertEqual(entry.payload, self.payload)
+        self.assertIn('view:movies', entry.permissions)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_unknown_token_is_a_miss(self):
+        self.assertEqual(self.cache.get('token'), None)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_expired_token_is_not_returned(self):
+        self.payload['exp'] = int(time.time()) - 1
+        self.cache.put('token', self.payload, self.store.get('key-1'))
+
+        self.assertEqual(self.cache.get('token'), None)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_token_of_rotated_key_is_not_returned(self):
+        self.cache.put('token', self.payload, self.store.get('key-1'))
+        with open(self.path, 'w') as f:
+            json.dump({'keys': [sample_jwk('key-2')]}, f)
+        self.store.refresh()
+
+        self.assertEqual(self.cache.get('token'), None)
+
+    def test_least_recently_used_token_is_evicted(self):
+        key = self.store.get('key-1')
+        self.cache.put('token1', self.payload, key)
+        self.cache.put('token2', self.payload, key)
+        self.cache.get('token1')
+        self.cache.put('token3', self.payload, key)
+
+        self.assertTrue(self.cache.get('token1'))
+        self.assertEqual(self.cache.get('token2'), None)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache test case"""
+
+    def setUp(self):
+        self.cache = LocalCache(maxsize=2, ttl=60)
+
+    def test_entries_are_tagged_with_embedded_resources(self):
+        body = {
+            'success': True,
+            'movies': [{'id': 1, 'actors': [{'id': 7}, {'id': 8}]}],
+            'total_movies': 1
+        }
+
+        self.assertEqual(tags_for(body),
+                         {'movie:1', 'actor:7', 'actor:8'})
+
+    def test_invalidated_tag_drops_its_entries(self):
+        self.cache.set('movie-page', 'body1', {'movies', 'actor:7'})
+        self.cache.set('actor-7', 'body2', {'actor:7'})
+        self.cache.invalidate({'actor:7'})
+
+        self.assertEqual(self.cache.get('movie-page'), None)
+        self.assertEqual(self.cache.get('actor-7'), None)
+
+    def test_expired_entry_is_not_returned(self):
+        self.cache.ttl = 0
+        self.cache.set('key', 'body', set())
+
+        self.assertEqual(self.cache.get('key'), None)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.set('key1', 'body1', set())
+        self.cache.set('key2', 'body2', set())
+        self.cache.get('key1')
+        self.cache.set('key3', 'body3', set())
+
+        self.assertEqual(self.cache.get('key1'), 'body1')
+        self.assertEqual(self.cache.get('key2'), None)
+
+
+class SerializerTestCase(unittest.TestCase):
+    """This class represents the JSON serializer backend test case"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.body = {
+            'success': True,
+            'movies': [{'id': 1, 'title': 'Amélie', 'actors': []}],
+            'total_movies': 1
+        }
+
+    def test_stdlib_output_matches_jsonify(self):
+        with self.app.app_context():
+            expected = jsonify(self.body).get_data()
+            output = StdlibSerializer().dumps(self.body) + b'\n'
+
+        self.assertEqual(output, expected)
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_output_decodes_to_the_same_document(self):
+        with self.app.app_context():
+            expected = StdlibSerializer().dumps(self.body)
+            output = OrjsonSerializer().dumps(self.body)
+
+        self.assertEqual(json.loads(output), json.loads(expected))
+        self.assertNotIn(b' ', output)
+
+
+class PoolTestCase(unittest.TestCase):
+    """This class represents the connection pool configuration test case"""
+
+    def setUp(self):
+        pool_metrics.reset()
+        self.engine = create_engine('sqlite://', poolclass=MeteredQueuePool,
+                                    pool_size=1, max_overflow=0,
+                                    pool_timeout=0.01)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_checkouts_are_measured(self):
+        self.engine.connect().close()
+
+        self.assertEqual(pool_metrics.checkouts, 1)
+        self.assertTrue(pool_metrics.wait_seconds >= 0)
+
+    def test_timeouts_are_counted(self):
+        connection = self.engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+        connection.close()
+
+        self.assertEqual(pool_metrics.timeouts, 1)
+
+    def test_postgres_statement_timeout(self):
+        os.environ['DB_STATEMENT_TIMEOUT'] = '5000'
+        try:
+            options = engine_options('postgresql://localhost/casting')
+        finally:
+            del os.environ['DB_STATEMENT_TIMEOUT']
+
+        self.assertEqual(options['connect_args']['options'],
+                         '-c statement_timeout=5000')
+        self.assertEqual(engine_options('sqlite://'), {})
+
+
+class StartupTestCase(SQLiteTestCase):
+    """This class represents the app startup test case"""
+
+    def tables(self):
+        return inspect(create_engine(self.database_url)).get_table_names()
+
+    def test_create_all_can_be_left_to_migrations(self):
+        self.create_app(DB_CREATE_ALL=False)
+
+        self.assertEqual(self.tables(), [])
+
+    def test_schema_is_created_once_per_database(self):
+        self.create_app()
+        self.assertIn('movie', self.tables())
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            self.create_app()
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+
+        self.assertEqual(statements, [])
+
+
+class ReplicaSetTestCase(unittest.TestCase):
+    """This class represents the read replica selection test case"""
+
+    def setUp(self):
+        self.replicas = ReplicaSet()
+        self.replicas.configure(['sqlite://', 'sqlite://'], retry_seconds=60)
+        self.first, self.second = self.replicas.engines
+
+    def tearDown(self):
+        self.replicas.configure([])
+
+    def test_replicas_are_used_in_turn(self):
+        chosen = [self.replicas.choose() for _ in range(4)]
+
+        self.assertEqual(chosen, [self.first, self.second,
+                                  self.first, self.second])
+
+    def test_failed_replica_is_skipped(self):
+        self.replicas.eject(self.first)
+
+        self.assertEqual(self.replicas.choose(), self.second)
+        self.assertEqual(self.replicas.choose(), self.second)
+
+    def test_no_replica_when_all_failed(self):
+        self.replicas.eject(self.first)
+        self.replicas.eject(self.second)
+
+        self.assertEqual(self.replicas.choose(), None)
+
+
+class ASGITestCase(SQLiteTestCase):
+    """This class represents the ASGI entry point test case"""
+
+    def setUp(self):
+        super().setUp()
+        flask_app = self.create_app()
+        with flask_app.app_context():
+            sample_movie().insert()
+        self.app = ASGIApplication(flask_app, threads=2)
+
+    async def serve(self):
+        received = asyncio.Queue()
+        events = []
+
+        async def send(message):
+            # whether the key refresher had stopped when it was sent
+            events.append((message['type'], self.app.refresher.done()))
+        lifespan = asyncio.ensure_future(self.app(
+            {'type': 'lifespan'}, received.get, send))
+        await received.put({'type': 'lifespan.startup'})
+        transport = httpx.ASGITransport(app=self.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://test') as client:
+            res = await client.get('/movies', headers=self.auth())
+        await received.put({'type': 'lifespan.shutdown'})
+        await lifespan
+        return events, res
+
+    def test_request_and_lifespan_events(self):
+        events, res = asyncio.run(self.serve())
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['movies'][0]['title'], 'Hannibal')
+        self.assertEqual(events, [('lifespan.startup.complete', False),
+                                  ('lifespan.shutdown.complete', True)])
+        self.assertTrue(self.app.client.is_closed)
+
+
+class BenchTestCase(unittest.TestCase):
+    """This class represents the benchmark harness test case"""
+
+    def test_self_signed_token_is_accepted(self):
+        directory = tempfile.mkdtemp()
+        issuer = LocalIssuer(directory)
+        app = create_app({
+            'DATABASE_URL': 'sqlite:///' + os.path.join(directory, 'db'),
+            'JWKS_URL': issuer.jwks_path
+        })
+
+        res = app.test_client().get('/health/pool')
+        self.assertEqual(res.status_code, 200)
+        res = app.test_client().get('/actors', headers=dict(
+            Authorization='Bearer ' + issuer.token(['view:actors'])))
+        self.assertEqual(res.status_code, 404)
+        res = app.test_client().get('/actors', headers=dict(
+            Authorization='Bearer ' + issuer.token(['view:movies'])))
+        self.assertEqual(res.status_code, 403)
+
+    def test_percentiles(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 100)
+
+    def test_regressions_beyond_tolerance_are_reported(self):
+        before = {'GET /movies': {'p95_ms': 10, 'rps': 100, 'queries': 4}}
+        after = {'GET /movies': {'p95_ms': 11, 'rps': 70, 'queries': 4}}
+
+        self.assertEqual(regressions(after, before, 0.2),
+                         [('GET /movies', 'rps', 100, 70)])
+
+
+class ProfilingTestCase(SQLiteTestCase):
+    """This class represents the request profiling test case"""
+
+    def create_app(self, **config):
+        app = super().create_app(**config)
+
+        @app.route('/count')
+        def count():
+            return dumps({'movies': Movie.query.count()})
+        return app
+
+    def test_server_timing_reports_queries_and_total(self):
+        app = self.create_app(SERVER_TIMING=True)
+
+        res = app.test_client().get('/count')
+        timing = res.headers['Server-Timing']
+
+        self.assertIn('db;dur=', timing)
+        self.assertIn('desc="1 queries"', timing)
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+    def test_slow_requests_are_logged(self):
+        app = self.create_app(PROFILING=True, SERVER_TIMING=False,
+                              SLOW_REQUEST_MS=0)
+
+        with self.assertLogs('profiling', 'WARNING') as logs:
+            res = app.test_client().get('/count')
+
+        self.assertNotIn('Server-Timing', res.headers)
+        self.assertIn('Slow request GET /count', logs.output[0])
+
+    def test_nothing_is_recorded_when_off(self):
+        app = self.create_app(PROFILING=False, SERVER_TIMING=False)
+
+        res = app.test_client().get('/count')
+
+        self.assertNotIn('Server-Timing', res.headers)
+        self.assertNotIn('start_profile', [
+            f.__name__ for f in app.before_request_funcs.get(None, [])])
+
+
+class MetricsTestCase(SQLiteTestCase):
+    """This class represents the metrics endpoint test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        metrics.reset()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_requests_and_auth_failures_are_counted(self):
+        app = self.create_app()
+        client = app.test_client()
+        client.get('/movies')
+        client.get('/movies/1')
+
+        body = client.get('/metrics').get_data(as_text=True)
+
+        self.assertIn('http_requests_total{method="GET",'
+                      'route="/movies/<int:movie_id>",status="401"} 1', body)
+        self.assertIn('http_request_duration_seconds_count{method="GET",'
+                      'route="/movies"} 1', body)
+        self.assertIn('auth_failures_total'
+                      '{code="authorization_header_missing"} 2', body)
+        self.assertIn('# TYPE db_pool_checkouts_total counter', body)
+        self.assertIn('response_cache_requests_total{result="miss"}', body)
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = Metrics()
+        registry.observe('http_request_duration_seconds', 0.003,
+                         route='/movies', method='GET')
+        registry.observe('http_request_duration_seconds', 0.2,
+                         route='/movies', method='GET')
+        registry.observe('http_request_duration_seconds', 60,
+                         route='/movies', method='GET')
+
+        body = registry.render()
+
+        labels = 'method="GET",route="/movies"'
+        self.assertIn(f'_bucket{{{labels},le="0.005"}} 1', body)
+        self.assertIn(f'_bucket{{{labels},le="0.25"}} 2', body)
+        self.assertIn(f'_bucket{{{labels},le="10.0"}} 2', body)
+        self.assertIn(f'_bucket{{{labels},le="+Inf"}} 3', body)
+        self.assertIn(f'_count{{{labels}}} 3', body)
+
+    def test_workers_are_added_up(self):
+        worker = Metrics()
+        worker.configure(self.directory, collectors=[
+            lambda: [('db_pool_size', {}, 5)]])
+        worker.inc('http_requests_total', route='/movies', method='GET',
+                   status='200')
+        worker.flush()
+        # a worker that exited: its counters are kept, its gauges dropped
+        with open(os.path.join(self.directory, '999999999.json'), 'w') as f:
+            json.dump([
+                ['http_requests_total', [['method', 'GET'],
+                                         ['route', '/movies'],
+                                         ['status', '200']], 2],
+                ['db_pool_size', [], 5]
+            ], f)
+
+        body = worker.render()
+
+        self.assertIn('http_requests_total{method="GET",route="/movies",'
+                      'status="200"} 3', body)
+        self.assertIn('db_pool_size 5\n', body)
+
+        mark_process_dead(self.directory, 999999999)
+
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         [f'{os.getpid()}.json', 'archive.json'])
+        self.assertEqual(render(worker.collect()), body)
+
+    def test_removed_directory_is_created_again(self):
+        worker = Metrics()
+        worker.configure(self.directory)
+        worker.inc('http_requests_total', route='/movies', method='GET',
+                   status='200')
+        shutil.rmtree(self.directory)
+
+        body = worker.render()
+
+        self.assertIn('http_requests_total{method="GET",route="/movies",'
+                      'status="200"} 1', body)
+        self.assertEqual(os.listdir(self.directory), [f'{os.getpid()}.json'])
+
+
+class CompressionTestCase(SQLiteTestCase):
+    """This class represents the response compression test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app(COMPRESS_MIN_SIZE=100)
+        self.body = json.dumps([{'id': i, 'name': 'Actor'}
+                                for i in range(20)])
+
+        @self.app.route('/large')
+        def large():
+            response = Response(self.body, mimetype='application/json')
+            response.set_etag('abc')
+            return response
+
+        @self.app.route('/small')
+        def small():
+            return jsonify({'success': True})
+
+        @self.app.route('/stream')
+        def stream():
+            return Response((line + '\n' for line in ['a,b'] * 100),
+                            mimetype='text/csv')
+        self.client = self.app.test_client()
+
+    def test_large_response_is_gzipped(self):
+        res = self.client.get('/large', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(int(res.headers['Content-Length']), len(res.data))
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(res.headers['ETag'], 'W/"abc"')
+        self.assertEqual(gzip.decompress(res.data).decode(), self.body)
+
+    def test_uncompressed_without_accept_encoding(self):
+        res = self.client.get('/large')
+
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(res.get_data(as_text=True), self.body)
+
+    def test_small_response_is_not_compressed(self):
+        res = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertTrue(res.get_json()['success'])
+
+    def test_streamed_response_is_compressed(self):
+        res = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertEqual(gzip.decompress(res.data).decode(), 'a,b\n' * 100)
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def test_brotli_is_preferred_unless_ranked_lower(self):
+        res = self.client.get('/large',
+                              headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(res.data).decode(), self.body)
+
+        res = self.client.get('/large',
+                              headers={'Accept-Encoding': 'gzip, br;q=0.5'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+
+    def test_weak_etag_of_compressed_copy_is_not_modified(self):
+        with self.app.test_request_context(
+                headers={'If-None-Match': 'W/"abc"'}):
+            self.assertTrue(not_modified('abc', None))
+
+
+class ProjectionTestCase(SQLiteTestCase):
+    """This class represents the sparse fieldset test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.context = self.app.app_context()
+        self.context.push()
+        movie = sample_movie()
+        movie.actors = [sample_actor(), sample_actor(name='actor2')]
+        movie.insert()
+
+    def tearDown(self):
+        self.context.pop()
+        super().tearDown()
+
+    def statements(self, query):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            rows = query.all()
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+        return rows, statements
+
+    def test_narrow_projection_selects_only_its_columns(self):
+        projection = Movie.projection(['title'])
+
+        rows, statements = self.statements(Movie.list_query(projection))
+
+        self.assertEqual(projection.format(rows[0]),
+                         {'id': 1, 'title': 'Hannibal'})
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('release_date', statements[0])
+        self.assertNotIn('actors', statements[0])
+
+    def test_format_is_the_full_projection(self):
+        movie = Movie.detail_query().one()
+
+        self.assertEqual(movie.format(), {
+            'id': 1,
+            'title': 'Hannibal',
+            'release_date': date(2020, 8, 9),
+            'actors': [actor.short_format() for actor in movie.actors]
+        })
+        self.assertEqual(set(movie.actors[0].short_format()),
+                         {'id', 'name', 'gender', 'age'})
+
+
+class SearchTestCase(SQLiteTestCase):
+    """This class represents the search test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.context = self.app.app_context()
+        self.context.push()
+        sample_movie('Hannibal Rising').insert()
+        sample_movie('100% Hannibal').insert()
+        sample_movie('Titanic').insert()
+
+    def tearDown(self):
+        self.context.pop()
+        super().tearDown()
+
+    def test_like_scan_escapes_the_term(self):
+        res = self.app.test_client().get('/search?q=100%25',
+                                         headers=self.auth('view:movies'))
+
+        self.assertEqual(res.status_code, 200)
+        titles = [movie['title'] for movie in res.get_json()['movies']]
+        self.assertEqual(titles, ['100% Hannibal'])
+
+    def test_postgres_without_pg_trgm_matches_full_text_only(self):
+        with mock.patch('models.search_backend', return_value='fulltext'):
+            query, order_by = search_query(Movie, Movie.title, 'hannibal')
+        sql = str(query.order_by(*order_by).statement.compile(
+            dialect=postgresql.dialect()))
+
+        # an ILIKE would scan the table without the trigram index
+        self.assertNotIn('ILIKE', sql)
+        self.assertIn('@@', sql)
+        self.assertIn('ts_rank', sql)
+        self.assertNotIn('similarity', sql)
+
+        with mock.patch('models.search_backend', return_value='trigram'):
+            query, order_by = search_query(Movie, Movie.title, 'hannibal')
+
+        sql = str(query.order_by(*order_by).statement.compile(
+            dialect=postgresql.dialect()))
+
+        self.assertIn('ILIKE', sql)
+        self.assertIn('similarity', sql)
+
+    def test_backend_is_looked_up_once_per_database(self):
+        self.assertEqual(search_backend(db.session.get_bind()), 'like')
+        self.assertEqual(search_backends[str(db.engine.url)], 'like')
+
+
+class ListingTestCase(SQLiteTestCase):
+    """This class represents the list filters and sorting test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.context = self.app.app_context()
+        self.context.push()
+        for title, day in [('a', date(2020, 8, 9)), ('b', None),
+                           ('c', date(1997, 12, 19)),
+                           ('d', date(2021, 5, 5))]:
+            sample_movie(title, day).insert()
+        for name, age, gender in [('x', 30, 'Female'), ('y', 45, 'male'),
+                                  ('z', 25, 'Male')]:
+            sample_actor(name, age, gender).insert()
+
+    def tearDown(self):
+        self.context.pop()
+        super().tearDown()
+
+    def titles(self, args):
+        query, order_by, _ = listing(Movie, args)
+        order = order_columns(order_by)
+        return [movie.title
+                for movie in query.order_by(*order_clauses(order))]
+
+    def pages(self, sort):
+        query, order_by, _ = listing(Movie, {'sort': sort})
+        order = order_columns(order_by)
+        titles, values = [], None
+        while True:
+            page = query.order_by(*order_clauses(order))
+            if values is not None:
+                page = page.filter(keyset_filter(order, values))
+            movie = page.first()
+            if movie is None:
+                return titles
+            titles.append(movie.title)
+            values = decode_cursor(cursor_for(movie, order), order)
+
+    def test_release_dates_in_the_stored_formats_are_parsed(self):
+        for value in ('2020-08-09', '2020.08.09', '2020/08/09',
+                      '09.08.2020', 'August 9, 2020', 'Aug 9, 2020'):
+            self.assertEqual(parse_release_date(value), date(2020, 8, 9))
+        with self.assertRaises(ValueError):
+            parse_release_date('soon')
+
+    def test_undated_movies_come_last_in_ascending_order(self):
+        self.assertEqual(self.titles({'sort': 'release_date'}),
+                         ['c', 'a', 'd', 'b'])
+        self.assertEqual(self.titles({'sort': '-release_date'}),
+                         ['b', 'd', 'a', 'c'])
+        self.assertEqual(self.titles({}), ['a', 'b', 'c', 'd'])
+
+    def test_cursor_pages_cross_the_undated_movies(self):
+        sample_movie('e', None).insert()
+
+        self.assertEqual(self.pages('release_date'),
+                         ['c', 'a', 'd', 'b', 'e'])
+        self.assertEqual(self.pages('-release_date'),
+                         ['e', 'b', 'd', 'a', 'c'])
+
+    def test_sorting_keeps_the_total(self):
+        _, _, filtered = listing(Movie, {'sort': 'release_date'})
+
+        self.assertFalse(filtered)
+
+    def test_release_date_range(self):
+        self.assertEqual(self.titles({'release_from': '2000-01-01',
+                                      'release_to': '2020.12.31'}), ['a'])
+
+    def test_actor_filters(self):
+        query, order_by, filtered = listing(
+            Actor, {'gender': 'MALE', 'age_max': '40', 'sort': 'age'})
+
+        self.assertTrue(filtered)
+        self.assertEqual([actor.name for actor in query.order_by(*order_by)],
+                         ['z'])
+
+    def test_invalid_arguments_are_rejected(self):
+        for args in ({'sort': 'budget'}, {'age_min': 'x'},
+                     {'release_to': 'soon'}):
+            with self.assertRaises(ValueError):
+                listing(Actor if 'age_min' in args else Movie, args)
+
+    def test_date_range_and_sort_use_the_index(self):
+        query, order_by, _ = listing(Movie, {'release_from': '2000-01-01',
+                                             'sort': 'release_date'})
+        statement = query.order_by(*order_by).statement.compile(
+            db.engine, compile_kwargs={'literal_binds': True})
+
+        plan = db.session.execute(f'EXPLAIN QUERY PLAN {statement}')
+
+        self.assertIn('ix_movie_release_date_id',
+                      ' '.join(str(row) for row in plan))
+
+
 if __name__ == "__main__":
     unittest.main()